@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# Timing harness for yasim2scad.py and pyopenscad.py.
+#
+# Usage:  python benchmark.py [-n RUNS] [benchmark ...]
+#
+# Without arguments all benchmarks are run.  Each reports the best and the
+# median wall time over RUNS runs.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE = os.path.join(HERE, "example-yasim.xml")
+
+
+def timed_runs(func, runs):
+    times = []
+    for i in range(runs):
+        t = time.time()
+        func()
+        times.append(time.time() - t)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def report(name, times):
+    print("%-40s best %8.2f ms   median %8.2f ms" % (name, times[0] * 1000, times[1] * 1000))
+
+
+def run_script(*args):
+    devnull = open(os.devnull, "w")
+    try:
+        subprocess.call([sys.executable] + list(args), stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+
+
+def bench_startup(runs):
+    """cold-start 'python yasim2scad.py', with and without a conversion"""
+    script = os.path.join(HERE, "yasim2scad.py")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        out = os.path.join(tmpdir, "out.scad")
+        report("python -c pass", timed_runs(lambda: run_script("-c", "pass"), runs))
+        report("import pyopenscad", timed_runs(lambda: run_script("-c", "import sys; sys.path.insert(0, %r); import pyopenscad" % HERE), runs))
+        report("yasim2scad.py (usage error)", timed_runs(lambda: run_script(script), runs))
+        report("yasim2scad.py example-yasim.xml", timed_runs(lambda: run_script(script, EXAMPLE, out), runs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def regex_parse_scad_callables(scad_code_str):
+    # The regex based pyopenscad.parse_scad_callables() this was replaced
+    # by, kept for comparison
+    import re
+    mod_re = r'(?mxs)^\s*(?:module|function)\s+(?P<callable_name>\w+)\s*\((?P<all_args>.*?)\)\s*(?:{|=)'
+    args_re = r'(?mxs)(?P<arg_name>\w+)(?:\s*=\s*(?P<default_val>[\w-]+|\[.*\]))?(?:,|$)'
+    callables = []
+    for m in re.finditer(mod_re, scad_code_str):
+        args = []
+        kwargs = []
+        all_args = m.group('all_args')
+        if all_args:
+            for am in re.finditer(args_re, all_args):
+                if am.group('default_val'):
+                    kwargs.append(am.group('arg_name'))
+                else:
+                    args.append(am.group('arg_name'))
+        callables.append({'name': m.group('callable_name'), 'args': args, 'kwargs': kwargs})
+    return callables
+
+
+def synthetic_scad_library(num_modules):
+    chunk = """
+// Part %(i)d of a generated library
+/* module old_part%(i)d( a, b) { cube( a); } */
+module part%(i)d( size=[10, 20, 30], offset=[0, 0, 0], label="part %(i)d", center=true) {
+    translate( offset) {
+        difference() {
+            cube( size, center=center);
+            for (i = [0 : 3]) {
+                rotate( [0, 0, i * 90]) translate( [size[0] / 4, 0, 0]) cylinder( r=1, h=size[2] + 1, center=true);
+            }
+        }
+    }
+}
+function part%(i)d_volume( size=[10, 20, 30]) = size[0] * size[1] * size[2];
+"""
+    return "".join(chunk % {"i": i} for i in range(num_modules))
+
+
+def synthetic_statement_library(num_modules):
+    # Modules whose body is a single statement rather than a {} block
+    return "".join("module part%d( size=[%d, 1, 1]) cube( size);\n" % (i, i) for i in range(num_modules))
+
+
+def bench_parse_signatures(runs):
+    """parse module/function signatures of generated SCAD libraries"""
+    sys.path.insert(0, HERE)
+    import pyopenscad
+    for label, code in [("block bodies", synthetic_scad_library(5000)),
+                        ("single-statement bodies", synthetic_statement_library(3000))]:
+        print("%s: %.2f MB, %d callables (regex parser finds %d)" % (label, len(code) / 1e6,
+                len(pyopenscad.parse_scad_callables(code)), len(regex_parse_scad_callables(code))))
+        report("  pyopenscad.parse_scad_callables", timed_runs(lambda: pyopenscad.parse_scad_callables(code), runs))
+        report("  regex parser (previous version)", timed_runs(lambda: regex_parse_scad_callables(code), runs))
+
+
+def synthetic_yasim_config(num_blocks):
+    # Each block has a few elements of geometry and, like real files, many more
+    # that the converter skips
+    chunk = """
+  <approach speed="%(i)d" aoa="4">
+    <control-setting axis="/controls/engines/engine[0]/throttle" value="0.2"/>
+    <control-setting axis="/controls/flight/flaps" value="1"/>
+    <solve-weight idx="0" weight="%(i)d"/>
+  </approach>
+  <wing x="-%(i)d" y="0.5" z="0.1" length="4" chord="1.2" incidence="2" twist="-2" taper="0.8">
+    <stall aoa="16" width="4" peak="1.5"/>
+    <flap0 start="0" end="0.5" lift="1.4" drag="1.2"/>
+    <spoiler start="0.5" end="0.9" lift="0.7" drag="5"/>
+    <control-input axis="/controls/flight/flaps" control="FLAP0"/>
+    <control-input axis="/controls/flight/aileron" control="FLAP1" split="true"/>
+    <control-output control="FLAP0" prop="/surface-positions/flap-pos-norm"/>
+    <control-speed control="FLAP0" transition-time="5"/>
+  </wing>
+  <propeller x="-%(i)d" y="1" z="0" mass="100" moment="2" radius="0.8" cruise-speed="120" cruise-rpm="2400">
+    <actionpt x="-%(i)d" y="1" z="0.1"/>
+    <piston-engine eng-power="160" eng-rpm="2700">
+      <control-input axis="/controls/engines/engine[0]/throttle" control="THROTTLE"/>
+      <control-input axis="/controls/engines/engine[0]/mixture" control="MIXTURE"/>
+    </piston-engine>
+    <control-input axis="/controls/engines/engine[0]/propeller-pitch" control="ADVANCE"/>
+  </propeller>
+  <fuselage ax="-%(i)d" ay="0" az="0" bx="-%(i)d.5" by="0" bz="0" width="1" taper="0.5" midpoint="0.3"/>
+  <gear x="-%(i)d" y="1" z="-1" compression="0.2">
+    <control-input axis="/controls/flight/rudder" control="STEER" square="true"/>
+    <control-input axis="/controls/gear/brake-left" control="BRAKE"/>
+  </gear>
+  <ballast x="-%(i)d" y="0" z="0" mass="10"/>
+"""
+    return "<airplane mass=\"1000\">\n%s</airplane>\n" % "".join(chunk % {"i": i} for i in range(num_blocks))
+
+
+def bench_read_yasim(runs):
+    """read large synthetic YASim files with the expat and the SAX front end"""
+    sys.path.insert(0, HERE)
+    import yasim2scad
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for num_blocks in (1000, 10000):
+            path = os.path.join(tmpdir, "synthetic-%d.xml" % num_blocks)
+            f = open(path, "w")
+            f.write(synthetic_yasim_config(num_blocks))
+            f.close()
+            print("%d blocks: %.2f MB" % (num_blocks, os.path.getsize(path) / 1e6))
+            for front_end in ("expat", "sax"):
+                converter = yasim2scad.YASimConverter(verbose = False, front_end = front_end)
+                report("  %s" % front_end, timed_runs(lambda: converter.read(path), runs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = [
+    ("startup", bench_startup),
+    ("signatures", bench_parse_signatures),
+    ("read", bench_read_yasim),
+]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Time yasim2scad.py and pyopenscad.py.")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="runs per measurement (default: 10)")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+            help="one of: %s (default: all)" % ", ".join(name for name, func in BENCHMARKS))
+    args = parser.parse_args()
+
+    selected = args.benchmarks or [name for name, func in BENCHMARKS]
+    for name, func in BENCHMARKS:
+        if name in selected:
+            print("%s: %s" % (name, func.__doc__))
+            func(args.runs)
+
+
+if __name__ == "__main__":
+    main()
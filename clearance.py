@@ -0,0 +1,230 @@
+# Clearance and interference checks between the parts of an aircraft: propeller
+# and rotor discs, fuselage tubes, and points such as gear contact points and
+# hitches.
+#
+# Each part is a Shape.  Candidate pairs come from a uniform grid over the
+# shapes' bounding boxes, so that only shapes that come close are compared,
+# rather than all pairs.  Each candidate pair is then measured by sampling the
+# surface of one shape and taking the exact distance of the samples to the other,
+# both ways round.  Distances are signed where a shape has an inside (tubes):
+# samples inside a tube count as negative, so overlapping volumes are always
+# caught.  Lengths are in meters, like in YASim files.
+#
+# Some parts are joined by design: fuselage tubes make up one fuselage, and gear
+# contact points and hitches often sit on its axis.  These pairs are only
+# checked on request, so that they don't hide real interference.
+
+import numpy as np
+
+# Samples per ring of discs and tubes, and the number of rings of discs
+RESOLUTION = 32
+
+
+def perpendiculars(normal):
+    """Two unit vectors perpendicular to normal and to each other."""
+    normal = normal / np.sqrt(np.dot(normal, normal))
+    other = np.identity(3)[np.argmin(np.abs(normal))]
+    u = np.cross(normal, other)
+    u /= np.sqrt(np.dot(u, u))
+    return (u, np.cross(normal, u))
+
+
+class Shape:
+    """A part, named name.  Subclasses have three methods: bounds(), the lower and
+    upper corner of the bounding box; samples(resolution), an N x 3 array of points
+    on the shape, about resolution along each ring; and distance(points), the
+    distance of each row of an N x 3 array of points to the shape, negative inside
+    it."""
+
+
+class Point(Shape):
+    def __init__(self, name, center):
+        self.name = name
+        self.center = np.asarray(center, dtype = float)
+
+    def bounds(self):
+        return (self.center, self.center)
+
+    def samples(self, resolution):
+        return self.center[np.newaxis]
+
+    def distance(self, points):
+        d = points - self.center
+        return np.sqrt((d * d).sum(axis = 1))
+
+
+class Disc(Shape):
+    """A flat disc, like the area a propeller or rotor sweeps."""
+
+    def __init__(self, name, center, normal, radius):
+        self.name = name
+        self.center = np.asarray(center, dtype = float)
+        self.normal = np.asarray(normal, dtype = float) / np.sqrt(np.dot(normal, normal))
+        self.radius = float(radius)
+
+    def bounds(self):
+        # The extent of a circle along each axis is radius times the sine of
+        # the angle between the axis and the normal
+        extent = self.radius * np.sqrt(np.maximum(1 - self.normal * self.normal, 0))
+        return (self.center - extent, self.center + extent)
+
+    def samples(self, resolution):
+        (u, v) = perpendiculars(self.normal)
+        alpha = np.arange(resolution) * (2 * np.pi / resolution)
+        rings = self.radius * np.arange(1, resolution // 4 + 2) / (resolution // 4 + 1)
+        circle = np.cos(alpha)[:, np.newaxis] * u + np.sin(alpha)[:, np.newaxis] * v
+        return np.concatenate([self.center[np.newaxis], self.center + (rings[:, np.newaxis, np.newaxis] * circle).reshape(-1, 3)])
+
+    def distance(self, points):
+        d = points - self.center
+        height = d.dot(self.normal)
+        inplane = d - height[:, np.newaxis] * self.normal
+        beyond = np.maximum(np.sqrt((inplane * inplane).sum(axis = 1)) - self.radius, 0)
+        return np.sqrt(height * height + beyond * beyond)
+
+
+class Tube(Shape):
+    """A fuselage tube from a to b, whose radius goes linearly from radii[0] at a to
+    radii[1] at the fraction midpoint of the way, and on to radii[2] at b."""
+
+    def __init__(self, name, a, b, radii, midpoint):
+        self.name = name
+        self.a = np.asarray(a, dtype = float)
+        self.b = np.asarray(b, dtype = float)
+        self.radii = np.asarray(radii, dtype = float)
+        self.midpoint = float(midpoint)
+
+    def radius(self, t):
+        return np.interp(t, [0, self.midpoint, 1], self.radii)
+
+    def bounds(self):
+        r = self.radii.max()
+        return (np.minimum(self.a, self.b) - r, np.maximum(self.a, self.b) + r)
+
+    def samples(self, resolution):
+        axis = self.b - self.a
+        (u, v) = perpendiculars(axis)
+        alpha = np.arange(resolution) * (2 * np.pi / resolution)
+        circle = np.cos(alpha)[:, np.newaxis] * u + np.sin(alpha)[:, np.newaxis] * v
+        t = np.union1d(np.linspace(0, 1, resolution // 2 + 1), [self.midpoint])
+        return (self.a + t[:, np.newaxis, np.newaxis] * axis + self.radius(t)[:, np.newaxis, np.newaxis] * circle).reshape(-1, 3)
+
+    def distance(self, points):
+        """The ends are flat, so points beyond them are measured to the end caps:
+
+        >>> body = Tube("body", [0, 0, 0], [-2, 0, 0], [0.3, 0.3, 0.3], 0.5)
+        >>> body.distance(np.array([[0.25, 0, 0], [0.25, 0.4, 0], [-1, 0.5, 0], [-1, 0, 0]]))
+        array([ 0.25      ,  0.26925824,  0.2       , -0.3       ])
+        >>> propeller = Disc("propeller", [0.1, 0, 0], [1, 0, 0], 0.5)
+        >>> round(pair_distance(body, propeller), 6)
+        0.1
+        """
+        axis = self.b - self.a
+        length = np.sqrt(np.dot(axis, axis))
+        d = points - self.a
+        # the position along the axis, in meters from a
+        s = d.dot(axis) / length if length else np.zeros(len(points))
+        off = d - (s / (length or 1))[:, np.newaxis] * axis
+        radial = np.sqrt((off * off).sum(axis = 1))
+        overshoot = np.maximum(np.maximum(-s, s - length), 0)
+        r = self.radius(np.clip(s / (length or 1), 0, 1))
+        inside = np.maximum(radial - r, -np.minimum(s, length - s))
+        beyond = np.maximum(radial - r, 0)
+        return np.where(overshoot > 0, np.sqrt(overshoot * overshoot + beyond * beyond), inside)
+
+
+
+def candidate_pairs(shapes, margin):
+    """The pairs (i, j), i < j, of shapes whose bounding boxes, grown by margin,
+    share a cell of a uniform grid; all pairs that can be closer than margin are
+    among them.  The cells are about as large as a typical shape, so each shape
+    is in few cells."""
+    bounds = np.array([shape.bounds() for shape in shapes])
+    lower = bounds[:, 0] - 0.5 * margin
+    upper = bounds[:, 1] + 0.5 * margin
+    cell = max(np.median((upper - lower).max(axis = 1)), margin, 1e-6)
+    first = np.floor(lower / cell).astype(int)
+    last = np.floor(upper / cell).astype(int)
+
+    cells = {}
+    for (i, (f, l)) in enumerate(zip(first.tolist(), last.tolist())):
+        for x in range(f[0], l[0] + 1):
+            for y in range(f[1], l[1] + 1):
+                for z in range(f[2], l[2] + 1):
+                    cells.setdefault((x, y, z), []).append(i)
+    pairs = set()
+    for members in cells.values():
+        for (k, i) in enumerate(members):
+            for j in members[k + 1:]:
+                pairs.add((i, j))
+    return sorted(pairs)
+
+def discs_cross(a, b):
+    """Whether discs a and b cut through each other, or overlap in the same plane."""
+    line = np.cross(a.normal, b.normal)
+    if np.dot(line, line) < 1e-18:
+        # parallel
+        if abs(np.dot(b.center - a.center, a.normal)) > 1e-9:
+            return False
+        d = b.center - a.center
+        return np.sqrt(np.dot(d, d)) <= a.radius + b.radius
+    # Each disc cuts the line where the planes meet along a chord; they cross if
+    # the chords overlap
+    origin = np.linalg.solve([a.normal, b.normal, line], [np.dot(a.normal, a.center), np.dot(b.normal, b.center), 0])
+    line /= np.sqrt(np.dot(line, line))
+    chords = []
+    for disc in (a, b):
+        t = np.dot(disc.center - origin, line)
+        off = disc.center - origin - t * line
+        h2 = np.dot(off, off)
+        if h2 > disc.radius * disc.radius:
+            return False
+        w = np.sqrt(disc.radius * disc.radius - h2)
+        chords.append((t - w, t + w))
+    return chords[0][0] <= chords[1][1] and chords[1][0] <= chords[0][1]
+
+def pair_distance(a, b, resolution = RESOLUTION):
+    """The distance between shapes a and b, negative if they overlap; as exact as
+    the sampling of their surfaces, except that crossing discs are always found."""
+    if isinstance(a, Disc) and isinstance(b, Disc) and discs_cross(a, b):
+        return 0.0
+    return min(b.distance(a.samples(resolution)).min(), a.distance(b.samples(resolution)).min())
+
+def check_clearance(shapes, margin = 0.1, resolution = RESOLUTION, joined = False):
+    """The pairs of shapes closer than margin, as (distance, a, b) tuples, closest
+    first.  Points aren't checked against each other.  Tubes against each other
+    and points in tubes are only reported with joined set.
+
+    >>> rotor = Disc("rotor", [0, 0, 1], [0, 0, 1], 2)
+    >>> propeller = Disc("propeller", [1, 0, 1], [1, 0, 0], 0.5)
+    >>> body = Tube("body", [0, 0, 0], [2, 0, 0], [0.2, 0.3, 0.2], 0.5)
+    >>> tail = Tube("tail", [2, 0, 0], [4, 0, 0], [0.2, 0.2, 0.1], 0.5)
+    >>> hitch = Point("hitch", [0, 0, 0])
+    >>> shapes = [rotor, propeller, body, tail, hitch]
+    >>> [(a.name, b.name) for (distance, a, b) in check_clearance(shapes)]
+    [('rotor', 'propeller')]
+    >>> [(a.name, b.name) for (distance, a, b) in check_clearance(shapes, joined = True)]
+    [('rotor', 'propeller'), ('body', 'tail'), ('body', 'hitch')]
+    """
+    results = []
+    for (i, j) in candidate_pairs(shapes, margin):
+        (a, b) = (shapes[i], shapes[j])
+        if isinstance(a, Point) and isinstance(b, Point):
+            continue
+        if not joined and isinstance(a, Tube) and isinstance(b, Tube):
+            continue
+        distance = pair_distance(a, b, resolution)
+        if not joined and distance <= 0 and Tube in (a.__class__, b.__class__) and Point in (a.__class__, b.__class__):
+            continue
+        if distance < margin:
+            results.append((distance, a, b))
+    results.sort(key = lambda result: result[0])
+    return results
+
+def clearance_report(results, tolerance = 0.0):
+    """The results of check_clearance as text; pairs closer than tolerance are
+    reported as collisions."""
+    if not results:
+        return "no parts are close to each other"
+    return "\n".join("%-9s %8.4f m  %s - %s" % (["close", "COLLISION"][distance <= tolerance], distance, a.name, b.name) \
+            for (distance, a, b) in results)
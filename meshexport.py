@@ -0,0 +1,340 @@
+# Turns pyopenscad scenes into triangle meshes and writes them as binary STL or
+# 3MF files, without OpenSCAD.
+#
+# The primitives of a scene (cubes, spheres, cylinders and polyhedra) are
+# tessellated the way OpenSCAD does, with pyopenscad.fragments() sides, moved by
+# the transformations above them and collected in a single vertex array and a
+# single triangle array.  There is no CSG: unions, intersections and hulls are
+# taken as the union of their children, which may overlap, and differences as
+# their first child.  That's all it takes for the overlays yasim2scad draws, and
+# it is thousands of times faster than CGAL.  Unlike in OpenSCAD's exports,
+# background (%) objects are included, as that's what all YASim elements are;
+# disabled (*) objects are left out.
+#
+# Triangles go counterclockwise seen from outside, as STL and 3MF expect.
+
+import os
+import zipfile
+import numpy as np
+
+from pyopenscad import fragments, prerendered_openscad_object, _replace_file
+
+DEG2RAD = np.pi / 180
+# The color of objects that have none
+DEFAULT_COLOR = (0.98, 0.84, 0.17, 1.0)
+
+
+class Mesh:
+    """Triangles: vertices is an N x 3 array of points, triangles an M x 3 array
+    of vertex indices, and materials holds the index into palette, a list of RGBA
+    tuples, of each triangle's color."""
+
+    def __init__(self, vertices, triangles, materials, palette):
+        self.vertices = vertices
+        self.triangles = triangles
+        self.materials = materials
+        self.palette = palette
+
+    def normals(self):
+        """The unit normal of each triangle; 0 for degenerate ones."""
+        (a, b, c) = self.vertices[self.triangles].transpose(1, 0, 2)
+        normals = np.cross(b - a, c - a)
+        lengths = np.sqrt((normals * normals).sum(axis = 1))[:, np.newaxis]
+        return normals / np.where(lengths == 0, 1, lengths)
+
+
+
+# Tessellation of the primitives, in their own frame.  Each function returns an
+# N x 3 array of points and an M x 3 array of triangles.
+
+def fan(polygon):
+    """Triangles that fill a convex polygon, a list of vertex indices."""
+    return [[polygon[0], polygon[i], polygon[i + 1]] for i in range(1, len(polygon) - 1)]
+
+def ring(r, segments, z):
+    alpha = np.arange(segments) * (2 * np.pi / segments)
+    return np.column_stack([r * np.cos(alpha), r * np.sin(alpha), np.repeat(float(z), segments)])
+
+def tessellate_cube(size, center):
+    if not isinstance(size, (list, tuple)):
+        size = [size] * 3
+    points = np.array([[x, y, z] for z in (0, 1) for y in (0, 1) for x in (0, 1)], dtype = float) * size
+    if center:
+        points -= 0.5 * np.asarray(size, dtype = float)
+    # corners are numbered x + 2 y + 4 z
+    quads = [[0, 2, 3, 1], [4, 5, 7, 6], [0, 1, 5, 4], [2, 6, 7, 3], [0, 4, 6, 2], [1, 3, 7, 5]]
+    return (points, np.array([t for quad in quads for t in fan(quad)]))
+
+def tessellate_cylinder(h, r1, r2, center, segments):
+    """Like OpenSCAD, a cone if one radius is 0."""
+    z0 = -0.5 * h if center else 0.0
+    if r1 > 0 and r2 > 0:
+        points = np.concatenate([ring(r1, segments, z0), ring(r2, segments, z0 + h)])
+        triangles = fan(range(segments)[::-1]) + fan(range(segments, 2 * segments))
+        for i in range(segments):
+            j = (i + 1) % segments
+            triangles += [[i, j, segments + j], [i, segments + j, segments + i]]
+        return (points, np.array(triangles))
+
+    # A cone: the tip follows the base
+    (r, base, tip) = (r1, z0, z0 + h) if r1 > 0 else (r2, z0 + h, z0)
+    points = np.concatenate([ring(r, segments, base), [[0.0, 0.0, tip]]])
+    triangles = [[j, i, segments] for (i, j) in ((i, (i + 1) % segments) for i in range(segments))]
+    # the base faces away from the tip
+    triangles += fan(range(segments))
+    if tip > base:
+        triangles = [t[::-1] for t in triangles]
+    return (points, np.array(triangles))
+
+def tessellate_sphere(r, segments):
+    """OpenSCAD's spheres: (segments + 1) / 2 rings of segments points, closed by
+    flat caps."""
+    rings = (segments + 1) // 2
+    phi = (np.arange(rings) + 0.5) * np.pi / rings
+    points = np.concatenate([ring(r * np.sin(p), segments, r * np.cos(p)) for p in phi])
+    triangles = fan(range(segments)) + fan(range(rings * segments - 1, (rings - 1) * segments - 1, -1))
+    for k in range(rings - 1):
+        for i in range(segments):
+            j = (i + 1) % segments
+            (a, b, c, d) = (k * segments + i, k * segments + j, (k + 1) * segments + j, (k + 1) * segments + i)
+            triangles += [[a, d, c], [a, c, b]]
+    return (points, np.array(triangles))
+
+def tessellate_polyhedron(points, faces):
+    # OpenSCAD's faces go clockwise seen from outside
+    return (np.asarray(points, dtype = float), np.array([t for face in faces for t in fan(face[::-1])]))
+
+
+
+# Transformations, as 4 x 4 matrices that act on column vectors
+
+def translation(v):
+    m = np.identity(4)
+    m[:len(v), 3] = v
+    return m
+
+def axis_rotation(angle, axis):
+    (x, y, z) = np.asarray(axis, dtype = float) / np.sqrt(np.dot(axis, axis))
+    (c, s) = (np.cos(angle * DEG2RAD), np.sin(angle * DEG2RAD))
+    m = np.identity(4)
+    m[:3, :3] = [[c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+                 [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+                 [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)]]
+    return m
+
+def rotation(a, v):
+    """OpenSCAD's rotate(a, v): about the x, then the y, then the z axis if a is a
+    vector, otherwise about v, or the z axis."""
+    if isinstance(a, (list, tuple)):
+        a = list(a) + [0] * (3 - len(a))
+        return axis_rotation(a[2], [0, 0, 1]).dot(axis_rotation(a[1], [0, 1, 0])).dot(axis_rotation(a[0], [1, 0, 0]))
+    return axis_rotation(a, v or [0, 0, 1])
+
+def scaling(v):
+    if not isinstance(v, (list, tuple)):
+        v = [v] * 3
+    return np.diag(list(v) + [1.0] * (4 - len(v)))
+
+def mirroring(v):
+    n = np.zeros(3)
+    n[:len(v)] = v
+    m = np.identity(4)
+    m[:3, :3] -= 2 * np.outer(n, n) / np.dot(n, n)
+    return m
+
+def transformation(obj):
+    """The matrix of a transformation node, or None if obj isn't one."""
+    params = obj.params
+    if obj.name == 'translate':
+        return translation(params['v'])
+    if obj.name == 'rotate':
+        return rotation(params['a'], params.get('v'))
+    if obj.name == 'scale':
+        return scaling(params.get('s') or params.get('v'))
+    if obj.name == 'mirror':
+        return mirroring(params.get('normal') or params.get('v'))
+    if obj.name == 'multmatrix':
+        m = np.identity(4)
+        rows = np.asarray(params['m'], dtype = float)
+        m[:len(rows), :rows.shape[1]] = rows
+        return m
+    return None
+
+def tessellate(obj):
+    """The points and triangles of a primitive, or None if obj isn't one.  Like in
+    OpenSCAD, sizes left out default to 1, and solids without volume have no
+    triangles:
+
+    >>> from pyopenscad import cylinder, cube
+    >>> len(tessellate(cylinder(r = 1, h = 2, segments = 8))[1])
+    28
+    >>> print(tessellate(cylinder(r = 1, h = 0, segments = 8)))
+    None
+    >>> print(tessellate(cube(size = [1, 0, 1])))
+    None
+    """
+    params = obj.params
+    if obj.name == 'cube':
+        size = params.get('size')
+        if size is None:
+            size = 1
+        if min(size if isinstance(size, (list, tuple)) else [size]) <= 0:
+            return None
+        return tessellate_cube(size, params.get('center'))
+    if obj.name == 'sphere':
+        r = params.get('r')
+        if r is None:
+            d = params.get('d')
+            r = 1 if d is None else 0.5 * d
+        if r <= 0:
+            return None
+        return tessellate_sphere(r, fragments(r, params.get('$fn') or 0))
+    if obj.name == 'cylinder':
+        r = params.get('r')
+        (r1, r2) = (params.get('r1'), params.get('r2'))
+        (r1, r2) = (r if r1 is None else r1, r if r2 is None else r2)
+        (r1, r2) = (r1 or 0, r2 or 0)
+        h = params.get('h')
+        if h is None:
+            h = 1
+        if (not r1 and not r2) or h <= 0:
+            return None
+        return tessellate_cylinder(h, r1, r2, params.get('center'), \
+                fragments(max(r1, r2), params.get('$fn') or 0))
+    if obj.name == 'polyhedron':
+        return tessellate_polyhedron(params['points'], params.get('faces') or params.get('triangles'))
+    return None
+
+
+
+def scene_mesh(scad_object):
+    """The mesh of all primitives below scad_object."""
+    vertices = []
+    triangles = []
+    materials = []
+    palette = []
+    colors = {}
+    primitives = {}
+    count = 0
+    # Entries are (object, matrix, color index)
+    stack = [(scad_object, np.identity(4), None)]
+    while stack:
+        (obj, matrix, material) = stack.pop()
+        if isinstance(obj, prerendered_openscad_object):
+            obj = obj.source
+        if obj.modifier == '*':
+            continue
+
+        local = transformation(obj)
+        if local is not None:
+            matrix = matrix.dot(local)
+        elif obj.name == 'color':
+            rgba = tuple(float(c) for c in obj.params['c']) + (1.0,) * (4 - len(obj.params['c']))
+            material = colors.get(rgba)
+            if material is None:
+                material = colors[rgba] = len(palette)
+                palette.append(rgba)
+
+        children = obj.children
+        if obj.name == 'difference':
+            children = children[:1]
+        for child in reversed(children):
+            stack.append((child, matrix, material))
+
+        # Markers and line dashes repeat a lot; polyhedra hardly ever do
+        if obj.name in ('cube', 'sphere', 'cylinder'):
+            key = (obj.name, repr(sorted(obj.params.items())))
+            primitive = primitives.get(key)
+            if primitive is None:
+                primitive = primitives[key] = tessellate(obj)
+        else:
+            primitive = tessellate(obj)
+        if primitive is None or not len(primitive[1]):
+            continue
+        (points, faces) = primitive
+        points = points.dot(matrix[:3, :3].T) + matrix[:3, 3]
+        if np.linalg.det(matrix[:3, :3]) < 0:
+            faces = faces[:, ::-1]
+        if material is None:
+            material = colors.get(DEFAULT_COLOR)
+            if material is None:
+                material = colors[DEFAULT_COLOR] = len(palette)
+                palette.append(DEFAULT_COLOR)
+        vertices.append(points)
+        triangles.append(faces + count)
+        materials.append(np.repeat(material, len(faces)))
+        count += len(points)
+
+    if not vertices:
+        return Mesh(np.zeros((0, 3)), np.zeros((0, 3), dtype = int), np.zeros(0, dtype = int), palette)
+    return Mesh(np.concatenate(vertices), np.concatenate(triangles), np.concatenate(materials), palette)
+
+
+
+STL_TRIANGLE = np.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attributes", "<u2")])
+
+def write_stl(mesh, path):
+    """Writes mesh to path as a binary STL file."""
+    records = np.zeros(len(mesh.triangles), dtype = STL_TRIANGLE)
+    records["normal"] = mesh.normals()
+    records["vertices"] = mesh.vertices[mesh.triangles]
+    f = open(path, "wb")
+    try:
+        f.write(("binary STL written by yasim2scad").ljust(80).encode("ascii"))
+        np.array([len(records)], dtype = "<u4").tofile(f)
+        records.tofile(f)
+    finally:
+        f.close()
+
+def write_3mf(mesh, path):
+    """Writes mesh to path as a 3MF file, with the color of each triangle.  Units
+    are millimeters, like OpenSCAD's."""
+    colors = "".join('<base name="color%d" displaycolor="#%02X%02X%02X%02X"/>' % ((i,) + tuple(int(round(255 * c)) for c in rgba)) \
+            for (i, rgba) in enumerate(mesh.palette))
+    # One format string for all vertices or triangles at once is much faster
+    # than formatting them one by one
+    vertices = ('<vertex x="%.6f" y="%.6f" z="%.6f"/>' * len(mesh.vertices)) % tuple(mesh.vertices.ravel())
+    triangles = np.column_stack([mesh.triangles, mesh.materials])
+    triangles = ('<triangle v1="%d" v2="%d" v3="%d" pid="1" p1="%d"/>' * len(triangles)) % tuple(triangles.ravel().tolist())
+    model = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<model unit="millimeter" xml:lang="en-US" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">'
+            '<resources><basematerials id="1">%s</basematerials>'
+            '<object id="2" type="model" pid="1" pindex="0"><mesh><vertices>%s</vertices><triangles>%s</triangles></mesh></object>'
+            '</resources><build><item objectid="2"/></build></model>\n') % (colors, vertices, triangles)
+
+    archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+    try:
+        archive.writestr("[Content_Types].xml", '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+                '</Types>\n')
+        archive.writestr("_rels/.rels", '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Target="/3D/3dmodel.model" Id="rel0" '
+                'Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+                '</Relationships>\n')
+        archive.writestr("3D/3dmodel.model", model)
+    finally:
+        archive.close()
+
+MESH_FORMATS = {".stl": write_stl, ".3mf": write_3mf}
+
+def mesh_render_to_file(scad_object, filepath):
+    """Writes the mesh of scad_object to filepath, as binary STL or 3MF depending
+    on its extension; returns the mesh.  Like pyopenscad.scad_render_to_file(),
+    it writes a temporary file that then replaces filepath in one step, so that
+    viewers that reload the file never see it half-written."""
+    writer = MESH_FORMATS.get(os.path.splitext(filepath)[1].lower())
+    if writer is None:
+        raise ValueError("%s: only .stl and .3mf files can be written" % filepath)
+    mesh = scene_mesh(scad_object)
+    import threading
+    tmp_filepath = "%s.%d.%d.tmp" % (filepath, os.getpid(), threading.current_thread().ident)
+    try:
+        writer(mesh, tmp_filepath)
+        _replace_file(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+    return mesh
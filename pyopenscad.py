@@ -34,7 +34,8 @@
 #------------------------------
 #-  from pyopenscad import *
 #-  call 'use( "/path/to/scadfile.scad")' or 'include("/path/to/scadfile.scad")'
-#    for any included SCAD code
+#    for any included SCAD code.  The callables are added to the calling
+#    module; pass e.g. 'namespace=globals()' to pick the namespace yourself.
 #-  OpenSCAD uses curly-brace blocks ({}) to create its tree.  PyOpenSCAD uses
 #    parentheses with comma-delimited lists.
 #    -  Ex:  OpenSCAD:
@@ -50,6 +51,9 @@
 #
 #-  Call scad_render( py_scad_obj)   to generate SCAD code. This returns a string
 #    of valid OpenSCAD code.
+#-  OR:  call  scad_render_to_stream( py_scad_obj, f) to write that code
+#      piece by piece to an open file-like object; large trees are never
+#      held in memory as a single string.
 #-  OR:  call  scad_render_to_file( py_scad_obj, filepath) to
 #      store that code in a file.
 #    -  If 'filepath' is open in the OpenSCAD IDE and Design =>
@@ -126,8 +130,15 @@
 #Evan
 
 
-import os, sys, re
-import inspect
+import os, sys, re, math
+
+# Parsed signatures of SCAD libraries, by absolute path: {path: ((mtime, size), signatures)}
+_signature_cache = {}
+# openscad_object subclasses made by use()/include(), by
+# (path, use_not_include, mtime, size)
+_used_classes = {}
+# If set, parsed signatures are also stored in this directory
+signature_cache_dir = os.environ.get( 'PYOPENSCAD_CACHE_DIR') or None
 
 openscad_builtins = [
     # 2D primitives
@@ -152,7 +163,7 @@ openscad_builtins = [
     {'name': 'resize',          'args': ['newsize'],         'kwargs': ['auto']} ,
     {'name': 'rotate',          'args': [],         'kwargs': ['a', 'v']} ,
     {'name': 'mirror',          'args': ['normal'], 'kwargs': []},
-    {'name': 'multmatrix',      'args': ['n'],      'kwargs': []},
+    {'name': 'multmatrix',      'args': ['m'],      'kwargs': []},
     {'name': 'color',           'args': ['c'],      'kwargs': []},
     {'name': 'minkowski',       'args': [],         'kwargs': []}  ,
     {'name': 'render',          'args': [],         'kwargs': ['convexity']},
@@ -181,120 +192,210 @@ openscad_builtins = [
     {'name': 'assign',          'args': [],         'kwargs': []}   # Not really needed for Python.  Also needs a **args argument so it accepts anything
 ]
 
-# Some functions need custom code in them; put that code here
-builtin_literals = {
-    'sphere': '''class sphere( openscad_object):
-        def __init__( self, r, segments=None):
-            kwargs = { 'r': r, }
-            if segments:
-                kwargs['$fn'] = segments
-            openscad_object.__init__(self, 'sphere', kwargs)
-
-''',
-    'cylinder': '''class cylinder( openscad_object):
-        def __init__( self, r, h, r1=None, center=None, segments=None):
-            kwargs = { 'h': h, 'center': center, }
-            if r1 is not None:
-                kwargs['r'] = r
-                kwargs['r1'] = r1
-            else:
-                kwargs['r'] = r
-            if segments:
-                kwargs['$fn'] = segments
-            openscad_object.__init__(self, 'cylinder', kwargs)
-
-''',
-    'circle': '''class circle( openscad_object):
-        def __init__( self, r, segments=None):
-            if segments:
-                openscad_object.__init__(self, 'circle', {'r': r, '$fn': segments})
-            else:
-                openscad_object.__init__(self, 'circle', {'r': r, })
-
-''',
-    'polygon': '''class polygon( openscad_object):
-        def __init__( self, points, paths=None):
-            if not paths:
-                paths = [ range( len( points))]
-            openscad_object.__init__( self, 'polygon', {'points':points, 'paths': paths})
-'''
-
-}
-
 # ===============
 # = Including OpenSCAD code =
 # ===============
-def use( scad_file_path, use_not_include=True):
+def use( scad_file_path, use_not_include=True, namespace=None):
     '''
     FIXME:  doctest needed
     '''
     # Opens scad_file_path, parses it for all usable calls,
-    # and adds them to caller's namespace
+    # and adds them to namespace: a module or a dict such as globals().
+    # If namespace isn't given, the caller's module namespace is used.
 
     # TODO: add something along the lines of PYTHONPATH for scad files?
     # That way you could 'use( a_file.scad)' without using an absolute
     # path or having the library in the same directory
     try:
-        module = open( scad_file_path)
-        contents = module.read()
-        module.close()
+        st = os.stat( scad_file_path)
     except Exception, e:
         raise Exception( "Failed to import SCAD module '%(scad_file_path)s' with error: %(e)s "%vars())
 
-    # Once we have a list of all callables and arguments, dynamically
-    # add openscad_object subclasses for all callables to the calling module's
-    # namespace.
-    symbols_dicts = extract_callable_signatures( scad_file_path)
+    if namespace is None:
+        namespace = calling_globals()
+    elif not isinstance( namespace, dict):
+        namespace = namespace.__dict__
 
-    for sd in symbols_dicts:
-        class_str = new_openscad_class_str( sd['name'], sd['args'], sd['kwargs'], scad_file_path, use_not_include)
-        exec class_str in calling_module().__dict__
+    # Once we have a list of all callables and arguments, dynamically
+    # add openscad_object subclasses for all callables to the
+    # namespace.  The classes are kept for as long as the file is
+    # unchanged, so using the same library again costs nothing.
+    key = (scad_file_path, use_not_include, st.st_mtime, st.st_size)
+    classes = _used_classes.get( key)
+    if classes is None:
+        symbols_dicts = extract_callable_signatures( scad_file_path)
+        classes = [(sd['name'], new_openscad_class( sd['name'], sd['args'], sd['kwargs'], scad_file_path, use_not_include))
+                        for sd in symbols_dicts]
+        _used_classes[key] = classes
+
+    namespace.update( classes)
 
     return True
 
-def include( scad_file_path):
-    return use( scad_file_path, use_not_include=False)
+def include( scad_file_path, namespace=None):
+    if namespace is None:
+        namespace = calling_globals()
+    return use( scad_file_path, use_not_include=False, namespace=namespace)
 
 
 # =========================================
 # = Rendering Python code to OpenSCAD code=
 # =========================================
-def scad_render( scad_object, file_header=''):
+def scad_render( scad_object, file_header='', instancing=False):
+    '''
+    Renders the whole tree containing scad_object, preceded by the 'use' and
+    'include' statements it needs.  Nesting depth is limited only by memory:
+
+    >>> t = cube( 1)
+    >>> for i in range( 5000):
+    ...     t = translate( v=[0, 0, 1])( t)
+    >>> scad_render( t).count( 'translate(v = [0, 0, 1])')
+    5000
+
+    With instancing set, subtrees that occur more than once are written as a
+    module, which is called wherever they occur:
+
+    >>> part = color( [1, 0, 0])( cube( 1))
+    >>> code = scad_render( union()( translate( [1, 0, 0])( part), translate( [2, 0, 0])( part.copy())), instancing=True)
+    >>> code.count( 'module instance_0()'), code.count( 'instance_0();'), code.count( 'cube(')
+    (1, 2, 1)
+    '''
+    return ''.join( _scad_render_chunks( scad_object, file_header, instancing))
+
+def scad_render_to_stream( scad_object, stream, file_header='', instancing=False):
+    '''
+    Writes the SCAD code for the whole tree containing scad_object to the
+    file-like object stream, without building the complete string first.
+    Even a chain of 50000 nested objects, whose indentation alone makes up
+    gigabytes of code, streams in small pieces:
+
+    >>> class Counter:
+    ...     chars = translates = 0
+    ...     def writelines( self, chunks):
+    ...         for chunk in chunks:
+    ...             self.chars += len( chunk)
+    ...             self.translates += chunk.count( 'translate(v = [0, 0, 1])')
+    >>> t = cube( 1)
+    >>> for i in range( 50000):
+    ...     t = translate( v=[0, 0, 1])( t)
+    >>> sink = Counter()
+    >>> scad_render_to_stream( t, sink)
+    >>> sink.translates, sink.chars > 2 * 10**9
+    (50000, True)
+    '''
+    stream.writelines( _scad_render_chunks( scad_object, file_header, instancing))
+
+def _scad_render_chunks( scad_object, file_header='', instancing=False):
     # Find the root of the tree, calling x.parent until there is none
     root = scad_object
     while root.parent:
         root = root.parent
 
-    # Scan the tree for all instances of
-    # included_openscad_object, storing their strings
-    def find_include_strings( obj):
-        include_strings = set()
-        if isinstance( obj, included_openscad_object):
-            include_strings.add( obj.include_string )
-        for child in obj.children:
-            include_strings.update( find_include_strings( child))
-        return include_strings
-
-    include_strings = find_include_strings( root)
-
-    # and render the string
-    includes = ''.join(include_strings) + "\n"
-    scad_body = root._render()
-    return file_header + includes + scad_body
+    # Render the body and collect the strings of all instances of
+    # included_openscad_object in the same pass; the includes are
+    # slotted in ahead of the module definitions and the body afterwards.
+    include_strings = []
+    chunks = [file_header, None]
+    substitutions = rendered_params = None
+    if instancing:
+        modules, substitutions, rendered_params = _find_instances( root)
+        for name, obj in modules:
+            chunks.append( "\nmodule " + name + "() {")
+            obj._render_chunks( chunks.append, 1, include_strings, None, rendered_params)
+            chunks.append( "\n}\n")
+    root._render_chunks( chunks.append, 0, include_strings, substitutions, rendered_params)
+    seen_includes = set()
+    unique_includes = []
+    for include_string in include_strings:
+        if include_string not in seen_includes:
+            seen_includes.add( include_string)
+            unique_includes.append( include_string)
+    chunks[1] = ''.join( unique_includes) + "\n"
+    return chunks
+
+def _find_instances( root, prefix='instance'):
+    # Finds the subtrees below root whose code occurs more than once.  Returns
+    # a list of (module name, subtree) for one copy of each, in the order they
+    # first occur, a dict that maps the id() of every copy to the call of its
+    # module, as the substitutions for _render_chunks(), and a dict of the
+    # parameters of all objects rendered on the way, so that rendering the
+    # tree doesn't have to do that again.  Leaves aren't
+    # worth a module, and only the outermost repeated subtrees are used;
+    # pre-rendered objects are compared by their code, as a whole.
+    #
+    # Number each distinct subtree bottom up: a subtree is identified by its
+    # own code and the numbers of its children
+    numbers = {}
+    node_numbers = {}
+    counts = []
+    rendered_params = {}
+    stack = [(root, False)]
+    while stack:
+        obj, children_done = stack.pop()
+        if isinstance( obj, prerendered_openscad_object):
+            key = obj.code
+        elif obj.children and not children_done:
+            stack.append( (obj, True))
+            stack.extend( (child, False) for child in obj.children)
+            continue
+        else:
+            params = rendered_params[id( obj)] = obj._render_params()
+            key = (obj.modifier, obj.name, params, tuple( node_numbers[id( child)] for child in obj.children))
+        number = numbers.get( key)
+        if number is None:
+            number = numbers[key] = len( counts)
+            counts.append( 0)
+        counts[number] += 1
+        node_numbers[id( obj)] = number
+
+    modules = []
+    names = {}
+    substitutions = {}
+    stack = list( reversed( root.children))
+    while stack:
+        obj = stack.pop()
+        number = node_numbers[id( obj)]
+        if counts[number] > 1 and (obj.children or isinstance( obj, prerendered_openscad_object)):
+            name = names.get( number)
+            if name is None:
+                name = names[number] = '%s_%d'%(prefix, len( modules))
+                modules.append( (name, obj))
+            substitutions[id( obj)] = openscad_object( name, {})
+        else:
+            stack.extend( reversed( obj.children))
+    return modules, substitutions, rendered_params
+
+def scad_render_to_file( scad_object, filepath=None, file_header='', include_orig_code=False, calling_file=None, instancing=False):
+    # calling_file is the Python file that generated scad_object.  It's only
+    # needed if filepath isn't supplied or include_orig_code is set, and
+    # defaults to the file of the calling module.
+    if calling_file is None and (include_orig_code or not filepath):
+        calling_file = calling_globals()['__file__']
+    if calling_file is not None:
+        calling_file = os.path.abspath( calling_file)
 
-def scad_render_to_file( scad_object, filepath=None, file_header='', include_orig_code=False):
-    rendered_string = scad_render( scad_object, file_header)
+    # If filepath isn't supplied, place a .scad file with the same name
+    # as the calling module next to it
+    if not filepath:
+        filepath = os.path.splitext( calling_file)[0] + '.scad'
 
-    calling_file = os.path.abspath( calling_module().__file__)
+    # The code is written to a temporary file next to filepath, which then
+    # replaces filepath in one step.  If the write fails, filepath is left
+    # alone, and OpenSCAD's automatic reload never sees a half-written file.
+    import threading
+    tmp_filepath = '%s.%d.%d.tmp'%(filepath, os.getpid(), threading.current_thread().ident)
+    f = open( tmp_filepath,"w")
+    try:
+        scad_render_to_stream( scad_object, f, file_header, instancing)
 
-    if include_orig_code:
-        # Once a SCAD file has been created, it's difficult to reconstruct
-        # how it got there, since it has no variables, modules, etc.  So, include
-        # the Python code that generated the scad code as comments at the end of
-        # the SCAD code
-        pyopenscad_str = open(calling_file, 'r').read()
+        if include_orig_code:
+            # Once a SCAD file has been created, it's difficult to reconstruct
+            # how it got there, since it has no variables, modules, etc.  So, include
+            # the Python code that generated the scad code as comments at the end of
+            # the SCAD code
+            pyopenscad_str = open(calling_file, 'r').read()
 
-        pyopenscad_str = '''
+            pyopenscad_str = '''
 /***********************************************
 ******      PyOpenSCAD code:       *************
 ************************************************
@@ -304,28 +405,90 @@ def scad_render_to_file( scad_object, filepath=None, file_header='', include_ori
 ***********************************************/
 
 '''%vars()
-        rendered_string += pyopenscad_str
+            f.write( pyopenscad_str)
+        f.close()
+        _replace_file( tmp_filepath, filepath)
+    finally:
+        f.close()
+        if os.path.exists( tmp_filepath):
+            os.remove( tmp_filepath)
+
+def _replace_file( src, dst):
+    try:
+        os.rename( src, dst)
+    except OSError:
+        # Windows won't rename onto an existing file
+        if not os.path.exists( dst):
+            raise
+        os.remove( dst)
+        os.rename( src, dst)
+
+
+# ====================
+# = Scene statistics =
+# ====================
+def fragments( r, fn=0, fa=12, fs=2):
+    '''
+    The number of sides OpenSCAD gives a circle of radius r, with the special
+    variables $fn, $fa and $fs set to fn, fa and fs (OpenSCAD's defaults
+    unless given):
 
-    # This write is destructive, and ought to do some checks that the write
-    # was successful.
-    # If filepath isn't supplied, place a .scad file with the same name
-    # as the calling module next to it
-    if not filepath:
-        filepath = os.path.splitext( calling_file)[0] + '.scad'
+    >>> fragments( 1), fragments( 100), fragments( 100, fn=8)
+    (5, 30, 8)
+    '''
+    if r < 1e-5:
+        return 3
+    if fn > 0:
+        return int( max( fn, 3))
+    return int( math.ceil( max( min( 360.0 / fa, r * 2 * math.pi / fs), 5)))
 
-    f = open( filepath,"w")
-    f.write( rendered_string)
-    f.close
+def count_facets( scad_object):
+    '''
+    Estimates how many facets OpenSCAD will make of the tree below scad_object:
+    the polygons of its spheres, cylinders, cubes and polyhedra, with spheres
+    and cylinders divided up as by fragments().  2D shapes and CSG results
+    aren't counted.
+
+    >>> count_facets( union()( cube( 1), cylinder( r=10, h=1, segments=8)))
+    16
+    '''
+    facets = 0
+    stack = [scad_object]
+    while stack:
+        obj = stack.pop()
+        if isinstance( obj, prerendered_openscad_object):
+            stack.append( obj.source)
+            continue
+        stack.extend( obj.children)
+        params = obj.params
+        if obj.name == 'cube':
+            facets += 6
+        elif obj.name == 'polyhedron':
+            facets += len( params.get( 'faces') or params.get( 'triangles') or ())
+        elif obj.name in ('sphere', 'cylinder'):
+            radii = [params.get( k) for k in ('r', 'r1', 'r2')] + [0.5 * (params.get( 'd') or 0)]
+            f = fragments( max( r for r in radii if r is not None), params.get( '$fn') or 0)
+            if obj.name == 'cylinder':
+                facets += f + 2
+            else:
+                facets += ((f + 1) // 2 - 1) * f + 2
+    return facets
 
 
 # =========================
 # = Internal Utilities    =
 # =========================
 class openscad_object( object):
+    # Generated scenes hold tens of thousands of these, so keep them free of
+    # a per-instance __dict__.  Subclasses should declare __slots__ too.
+    __slots__ = ('name', 'params', 'children', 'modifier', 'parent')
+
     def __init__(self, name, params):
         self.name = name
         self.params = params
-        self.children = []
+        # Most objects are leaves; they share one empty tuple until add()
+        # gives them a list of their own
+        self.children = ()
         self.modifier = ""
         self.parent= None
 
@@ -351,41 +514,85 @@ class openscad_object( object):
         Calling obj._render also won't include necessary 'use' or 'include' statements
 
         '''
-        s = "\n" + self.modifier + self.name + "("
-        first = True
+        chunks = []
+        self._render_chunks( chunks.append, 0)
+        return ''.join( chunks)
 
+    def _render_chunks( self, write, depth=0, include_strings=None, substitutions=None, rendered_params=None):
+        '''
+        Walks this object and its children once, handing each piece of SCAD
+        code to write().  Indentation is tracked as a depth counter instead
+        of re-indenting each child's rendered string, so the cost is linear
+        in the size of the output.
+
+        The walk uses an explicit stack rather than recursion, so arbitrarily
+        deep trees don't run into Python's recursion limit.  If include_strings
+        is a list, the include string of every included_openscad_object
+        found along the way is appended to it once.  substitutions maps the
+        id() of objects below this one to the objects rendered in their place,
+        rendered_params the id() of objects to their already rendered
+        parameters.
+        '''
+        seen_includes = set()
+        # Entries are (object, depth), or (None, closing_brace) once all of an
+        # object's children have been pushed
+        stack = [(self, depth)]
+        while stack:
+            obj, depth = stack.pop()
+            if obj is None:
+                write( depth)
+                continue
+            if substitutions:
+                obj = substitutions.get( id( obj), obj)
+
+            if isinstance( obj, prerendered_openscad_object):
+                if include_strings is not None:
+                    for include_string in obj.include_strings:
+                        if include_string not in seen_includes:
+                            seen_includes.add( include_string)
+                            include_strings.append( include_string)
+                write( obj._code_at( depth))
+                continue
+
+            if include_strings is not None and isinstance( obj, included_openscad_object):
+                if obj.include_string not in seen_includes:
+                    seen_includes.add( obj.include_string)
+                    include_strings.append( obj.include_string)
+
+            tabs = "\t" * depth
+            params = rendered_params.get( id( obj)) if rendered_params else None
+            if params is None:
+                params = obj._render_params()
+            write( "\n" + tabs + obj.modifier + obj.name + "(" + params + ")")
+            if obj.children:
+                write( " {")
+                stack.append( (None, "\n" + tabs + "}"))
+                for child in reversed( obj.children):
+                    stack.append( (child, depth + 1))
+            else:
+                write( ";")
+
+    def _render_params( self):
         valid_keys = self.params.keys()
 
         # intkeys are the positional parameters
-        intkeys = filter(lambda x: type(x)==int, valid_keys)
-        intkeys.sort()
+        intkeys = sorted( k for k in valid_keys if type(k) == int)
 
         # named parameters
-        nonintkeys = filter(lambda x: not type(x)==int, valid_keys)
+        nonintkeys = [k for k in valid_keys if not type(k) == int]
 
-        for k in intkeys+nonintkeys:
+        rendered = []
+        for k in intkeys + nonintkeys:
             v = self.params[k]
             if v == None:
                 continue
 
-            if not first:
-                s += ", "
-            first = False
-
-            if type(k)==int:
-                s += py2openscad(v)
+            if type(k) == int:
+                rendered.append( py2openscad(v))
             else:
-                s += k + " = " + py2openscad(v)
-
-        s += ")"
-        if self.children != None and len(self.children) > 0:
-            s += " {"
-            for child in self.children:
-                s += indent(child._render())
-            s += "\n}"
-        else:
-            s += ";"
-        return s
+                rendered.append( k + " = " + py2openscad(v))
+
+        return ", ".join( rendered)
 
     def add(self, child):
         '''
@@ -398,7 +605,10 @@ class openscad_object( object):
         if isinstance( child, list) or isinstance( child, tuple):
             [self.add( c) for c in child]
         else:
-            self.children.append(child)
+            if self.children:
+                self.children.append(child)
+            else:
+                self.children = [child]
             child.set_parent( self)
         return self
 
@@ -413,9 +623,21 @@ class openscad_object( object):
         # Provides a copy of this object and all children,
         # but doesn't copy self.parent, meaning the new object belongs
         # to a different tree
-        other = openscad_object( self.name, self.params)
-        for c in self.children:
-            other.add( c.copy())
+        other = self._copy_node()
+        stack = [(self, other)]
+        while stack:
+            orig, dup = stack.pop()
+            for c in orig.children:
+                c_dup = c._copy_node()
+                dup.add( c_dup)
+                stack.append( (c, c_dup))
+        return other
+
+    def _copy_node( self):
+        # Copies this object alone, keeping its class and modifier
+        other = object.__new__( self.__class__)
+        openscad_object.__init__( other, self.name, dict( self.params))
+        other.modifier = self.modifier
         return other
 
     def __call__( self, *args):
@@ -457,6 +679,8 @@ class included_openscad_object( openscad_object):
     represents imported scad code, so each instance needs to store the path
     to the scad file it's included from.
     '''
+    __slots__ = ('include_file_path', 'include_string')
+
     def __init__( self, name, params, include_file_path, use_not_include=False):
         self.include_file_path = include_file_path
         if use_not_include:
@@ -466,6 +690,58 @@ class included_openscad_object( openscad_object):
 
         openscad_object.__init__( self, name, params)
 
+    def _copy_node( self):
+        other = openscad_object._copy_node( self)
+        other.include_file_path = self.include_file_path
+        other.include_string = self.include_string
+        return other
+
+
+class prerendered_openscad_object( openscad_object):
+    '''
+    Stands in for an object tree whose SCAD code has already been rendered,
+    so that a tree which is added to many scenes unchanged is only rendered
+    once.  The tree itself is kept as self.source, but it is the code
+    rendered when this object was created that scad_render() writes out;
+    changes to the source after that aren't picked up.
+
+    >>> tree = translate( [1, 2, 3])( sphere( 1))
+    >>> fragment = prerendered_openscad_object( tree)
+    >>> scad_render( union()( fragment, cube( 1))) == scad_render( union()( tree.copy(), cube( 1)))
+    True
+    '''
+    __slots__ = ('source', 'code', 'include_strings', '_indented')
+
+    def __init__( self, source):
+        openscad_object.__init__( self, source.name, {})
+        self.source = source
+        self.include_strings = []
+        chunks = []
+        source._render_chunks( chunks.append, 0, self.include_strings)
+        self.code = ''.join( chunks)
+        self._indented = {0: self.code}
+
+    def _code_at( self, depth):
+        # The code is rendered at depth 0; deeper copies are made on demand
+        # and kept, since a fragment is usually rendered at the same depth
+        # every time
+        code = self._indented.get( depth)
+        if code is None:
+            code = self._indented[depth] = self.code.replace( "\n", "\n" + "\t" * depth)
+        return code
+
+    def add( self, child):
+        raise TypeError( "can't add children to pre-rendered SCAD code")
+
+    def _copy_node( self):
+        # Copies share the rendered code, which is never modified
+        other = object.__new__( self.__class__)
+        openscad_object.__init__( other, self.name, {})
+        other.source = self.source
+        other.code = self.code
+        other.include_strings = self.include_strings
+        other._indented = self._indented
+        return other
 
 
 def calling_module():
@@ -476,38 +752,58 @@ def calling_module():
 
     Got that?
     '''
-    frm = inspect.stack()[2]
-    calling_mod = inspect.getmodule( frm[0])
-    return calling_mod
-
-def new_openscad_class_str( class_name, args=[], kwargs=[], include_file_path=None, use_not_include=True):
-    args_str = ''
-    args_pairs = ''
+    return sys.modules.get( sys._getframe( 2).f_globals.get( '__name__'))
 
-    for arg in args:
-        args_str += ', '+arg
-        args_pairs += "'%(arg)s':%(arg)s, "%vars()
+def calling_globals():
+    '''
+    Like calling_module(), but returns the global namespace of the code 2
+    back in the frame stack.  Only that one frame is looked at; building
+    the full records of inspect.stack() is far more expensive.
+    '''
+    return sys._getframe( 2).f_globals
 
-    # kwargs have a default value defined in their SCAD versions.  We don't
-    # care what that default value will be (SCAD will take care of that), just
-    # that one is defined.
-    for kwarg in kwargs:
-        args_str += ', %(kwarg)s=None'%vars()
-        args_pairs += "'%(kwarg)s':%(kwarg)s, "%vars()
+def new_openscad_class( class_name, args=[], kwargs=[], include_file_path=None, use_not_include=True):
+    '''
+    Returns a new openscad_object subclass called class_name, whose
+    constructor takes the positional args and the optional kwargs of the
+    OpenSCAD callable it stands for.  The class is put together directly
+    rather than by exec'ing generated source, which keeps importing this
+    module and use()-ing large libraries cheap.
+    '''
+    names = list( args) + list( kwargs)
+    n_names = len( names)
+
+    def __init__( self, *pos_args, **kw_args):
+        if len( pos_args) > n_names:
+            raise TypeError( "%s() takes at most %d arguments (%d given)"%(class_name, n_names, len( pos_args)))
+        # kwargs have a default value defined in their SCAD versions.  We don't
+        # care what that default value will be (SCAD will take care of that), just
+        # that one is defined.  Fill in the parameters in declaration order,
+        # like a literal {arg:arg, ...} would.
+        given = dict( zip( names, pos_args))
+        for k, v in kw_args.items():
+            if k not in names:
+                raise TypeError( "%s() got an unexpected keyword argument '%s'"%(class_name, k))
+            if k in given:
+                raise TypeError( "%s() got multiple values for keyword argument '%s'"%(class_name, k))
+            given[k] = v
+        params = {}
+        for name in names:
+            if name not in given and name in args:
+                raise TypeError( "%s() missing required argument '%s'"%(class_name, name))
+            params[name] = given.get( name)
+
+        if include_file_path:
+            included_openscad_object.__init__( self, class_name, params, include_file_path, use_not_include)
+        else:
+            openscad_object.__init__( self, class_name, params)
 
     if include_file_path:
-        result = '''class %(class_name)s( included_openscad_object):
-        def __init__(self%(args_str)s):
-            included_openscad_object.__init__(self, '%(class_name)s', {%(args_pairs)s }, include_file_path='%(include_file_path)s', use_not_include=%(use_not_include)s )
-
-'''%vars()
+        base = included_openscad_object
     else:
-        result = '''class %(class_name)s( openscad_object):
-        def __init__(self%(args_str)s):
-            openscad_object.__init__(self, '%(class_name)s', {%(args_pairs)s })
+        base = openscad_object
 
-'''%vars()
-    return result
+    return type( class_name, (base,), {'__slots__': (), '__init__': __init__})
 
 def py2openscad(o):
     if type(o) == bool:
@@ -515,15 +811,7 @@ def py2openscad(o):
     if type(o) == float:
         return "%.10f" % o
     if type(o) == list:
-        s = "["
-        first = True
-        for i in o:
-            if not first:
-                s +=    ", "
-            first = False
-            s += py2openscad(i)
-        s += "]"
-        return s
+        return "[" + ", ".join( [py2openscad(i) for i in o]) + "]"
     if type(o) == str:
         return '"' + o + '"'
     return str(o)
@@ -536,73 +824,287 @@ def indent(s):
 # = Parsing =
 # ===========
 def extract_callable_signatures( scad_file_path):
-    scad_code_str = open(scad_file_path).read()
-    return parse_scad_callables( scad_code_str)
+    '''
+    Returns parse_scad_callables() of the file at scad_file_path.  Results
+    are cached in memory, and on disk if a signature cache directory is set
+    (see set_signature_cache_dir()), for as long as the file's path,
+    modification time and size stay the same.  Don't modify the result.
+    '''
+    path = os.path.abspath( scad_file_path)
+    st = os.stat( path)
+    stamp = (st.st_mtime, st.st_size)
+
+    cached = _signature_cache.get( path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    signatures = None
+    if signature_cache_dir:
+        signatures = _load_cached_signatures( path, stamp)
+
+    if signatures is None:
+        scad_code_str = open(scad_file_path).read()
+        signatures = parse_scad_callables( scad_code_str)
+        if signature_cache_dir:
+            _store_cached_signatures( path, stamp, signatures)
+
+    _signature_cache[path] = (stamp, signatures)
+    return signatures
+
+def set_signature_cache_dir( path):
+    '''
+    Keep parsed SCAD library signatures in directory path as well as in
+    memory, so that they survive across processes.  None turns the disk
+    cache off.  Defaults to $PYOPENSCAD_CACHE_DIR if that is set.
+    '''
+    global signature_cache_dir
+    signature_cache_dir = path
+
+def _signature_cache_file( path):
+    import hashlib
+    return os.path.join( signature_cache_dir, hashlib.sha1( path).hexdigest() + '.pickle')
+
+def _load_cached_signatures( path, stamp):
+    import cPickle as pickle
+    try:
+        f = open( _signature_cache_file( path), 'rb')
+        try:
+            cached_path, cached_stamp, signatures = pickle.load( f)
+        finally:
+            f.close()
+    except Exception:
+        # Missing or unreadable cache entries just mean parsing again
+        return None
+    if cached_path != path or cached_stamp != stamp:
+        return None
+    return signatures
+
+def _store_cached_signatures( path, stamp, signatures):
+    import cPickle as pickle
+    cache_file = _signature_cache_file( path)
+    try:
+        if not os.path.isdir( signature_cache_dir):
+            os.makedirs( signature_cache_dir)
+        # Write to a temporary file first, so other processes never see
+        # a half-written entry
+        tmp_file = '%s.%d.tmp'%(cache_file, os.getpid())
+        f = open( tmp_file, 'wb')
+        try:
+            pickle.dump( (path, stamp, signatures), f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename( tmp_file, cache_file)
+    except (IOError, OSError):
+        # The disk cache is only an optimization
+        pass
+
+# Top-level scan: only the tokens that matter for finding definitions are
+# matched; everything in between is skipped by the regex engine.  Comments and
+# strings are matched whole, so anything inside them is ignored.  Every
+# alternative starts with a literal character (that's why there are no named
+# groups and the keywords check the preceding character with a lookbehind),
+# which lets the regex engine skip ahead to candidates quickly.
+_scad_scan_re = re.compile( r"""
+      //[^\n]*
+    | /\*[\s\S]*?(?:\*/|\Z)
+    | "(?:[^"\\]|\\.)*(?:"|\Z)
+    | \{
+    | \}
+    | m(?<![\w$]m)odule\b
+    | f(?<![\w$]f)unction\b
+""", re.VERBOSE)
+
+_scad_gap = r'(?:\s+|//[^\n]*|/\*[\s\S]*?(?:\*/|\Z))*'
+
+# 'name(' following a module/function keyword
+_scad_signature_start_re = re.compile( _scad_gap + r'([A-Za-z_$][\w$]*)' + _scad_gap + r'\(')
+# The name of one argument in a signature
+_scad_arg_name_re = re.compile( _scad_gap + r'([A-Za-z_$][\w$]*)')
+# Whatever follows a signature: '=' for a function
+_scad_signature_end_re = re.compile( _scad_gap + r'(=?)')
+# Fast path for the common argument lists: no comments, escaped quotes or
+# brackets other than unnested [...], which can be taken apart with one regex
+_scad_simple_args_re = re.compile( r'((?:[^()"/\[\]{}]|\[[^()"/\[\]{}]*\]|"[^"\\]*")*)\)')
+_scad_simple_arg_re = re.compile( r'\s*([A-Za-z_$][\w$]*)\s*(=?)(?:[^,\["]|\[[^\]]*\]|"[^"]*")*')
+# Characters in an argument list that need a closer look
+_scad_arg_punct_re = re.compile( r'[()\[\]{},="/]')
+
+_scad_open_brackets = { '(': ')', '[': ']', '{': '}'}
+
+def _parse_scad_signature( keyword, scad_code_str, pos):
+    # Parses 'name( args)' following a module/function keyword that ends at
+    # pos.  Returns a callable dict, or None if this isn't a definition.
+    m = _scad_signature_start_re.match( scad_code_str, pos)
+    if not m:
+        return None
+    name = m.group( 1)
+
+    args = []
+    kwargs = []
+    pos = m.end()
+    m = _scad_simple_args_re.match( scad_code_str, pos)
+    if m:
+        for arg in _scad_simple_arg_re.finditer( m.group( 1)):
+            [args, kwargs][bool( arg.group( 2))].append( arg.group( 1))
+        pos = m.end()
+    else:
+        pos = _parse_scad_args( scad_code_str, pos, args, kwargs)
+        if pos is None:
+            return None
+
+    # Functions are defined with '=', modules with a body
+    is_function = bool( _scad_signature_end_re.match( scad_code_str, pos).group( 1))
+    if is_function != (keyword == 'function'):
+        return None
+
+    return { 'name': name, 'args': args, 'kwargs': kwargs}
+
+def _parse_scad_args( scad_code_str, pos, args, kwargs):
+    # Splits the argument list starting at pos on the commas that aren't
+    # nested in any brackets; each argument is a name, optionally followed
+    # by '=' and a default value of any complexity.  Returns the position
+    # after the closing ')', or None if the list is malformed.
+    nesting = []
+    has_default = False
+    arg_start = pos
+    search = _scad_arg_punct_re.search
+    while True:
+        m = search( scad_code_str, pos)
+        if not m:
+            return None
+        c = m.group()
+        pos = m.end()
+        if c == '"' or c == '/':
+            # Skip strings and comments whole; a lone '/' is a division
+            m = _scad_scan_re.match( scad_code_str, m.start())
+            if m:
+                pos = m.end()
+        elif c in _scad_open_brackets:
+            nesting.append( _scad_open_brackets[c])
+        elif nesting:
+            if c in ')]}' and nesting.pop() != c:
+                return None
+        elif c == ',' or c == ')':
+            arg = _scad_arg_name_re.match( scad_code_str, arg_start, m.start())
+            if arg:
+                [args, kwargs][has_default].append( arg.group( 1))
+            arg_start = pos
+            has_default = False
+            if c == ')':
+                return pos
+        elif c == '=':
+            has_default = True
+        else:
+            # unbalanced ']' or '}'
+            return None
 
 def parse_scad_callables( scad_code_str):
-    """
-    >>> test_str = '''module hex (width=10, height=10,
-...  flats= true, center=false){}
-...     function righty (angle=90) = 1;
-...     function lefty( avar) = 2;
-...     module more( a=[something, other]) {}
-...     module pyramid(side=10, height=-1, square=false, centerHorizontal=true, centerVertical=false){}
-... '''
->>> parse_scad_callables( test_str)
-[{'args': [], 'name': 'hex', 'kwargs': ['width', 'height', 'flats', 'center']}, {'args': [], 'name': 'righty', 'kwargs': ['angle']}, {'args': ['avar'], 'name': 'lefty', 'kwargs': []}, {'args': [], 'name': 'more', 'kwargs': ['a']}, {'args': [], 'name': 'pyramid', 'kwargs': ['side', 'height', 'square', 'centerHorizontal', 'centerVertical']}]
-    """
+    '''
+    Returns the names and arguments of all top-level modules and functions
+    defined in scad_code_str.  Arguments with a default value are listed as
+    'kwargs', all others as 'args'.
+
+    >>> test_str = """module hex (width=10, height=10,
+    ...  flats= true, center=false){}
+    ...     function righty (angle=90) = 1;
+    ...     function lefty( avar) = 2;
+    ...     module more( a=[something, other]) {}
+    ...     module pyramid(side=10, height=-1, square=false, centerHorizontal=true, centerVertical=false){}
+    ... """
+    >>> parse_scad_callables( test_str)
+    [{'args': [], 'name': 'hex', 'kwargs': ['width', 'height', 'flats', 'center']}, {'args': [], 'name': 'righty', 'kwargs': ['angle']}, {'args': ['avar'], 'name': 'lefty', 'kwargs': []}, {'args': [], 'name': 'more', 'kwargs': ['a']}, {'args': [], 'name': 'pyramid', 'kwargs': ['side', 'height', 'square', 'centerHorizontal', 'centerVertical']}]
+
+    Comments, strings, nested default values and modules local to another
+    module don't confuse it:
+
+    >>> test_str = """// module commented( x) {}
+    ... /* function a( x) = x+3;
+    ... */
+    ... function a( x, y=[[1, 2], [3, (4)]]) = x+y;
+    ... module label( text="module fake( z) {", size=f( 1, 2), center) {
+    ...     module local( q) {}
+    ... }
+    ... """
+    >>> parse_scad_callables( test_str)
+    [{'args': ['x'], 'name': 'a', 'kwargs': ['y']}, {'args': ['center'], 'name': 'label', 'kwargs': ['text', 'size']}]
+    '''
+    # This scans the code once, in linear time.  It doesn't evaluate
+    # anything: if a callable is defined twice, both definitions are
+    # returned, and the last one wins when use()d, like in OpenSCAD.
     callables = []
+    depth = 0
+    for m in _scad_scan_re.finditer( scad_code_str):
+        c = scad_code_str[m.start()]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            if depth:
+                depth -= 1
+        elif (c == 'm' or c == 'f') and depth == 0:
+            # The signature is parsed on its own, but the scan carries on
+            # through it: comments and strings in it are skipped the same way,
+            # so the brace depth stays right.
+            callable_dict = _parse_scad_signature( m.group(), scad_code_str, m.end())
+            if callable_dict:
+                callables.append( callable_dict)
 
-    # Note that this isn't comprehensive; tuples or comments in a module definition
-    # will defeat it.  Functions/modules that have been commented out will also be included,
-    # which will cause errors if multiple versions of a callable exist in the file: e.g
-    # function a( x, y) = x+y;
-    # /*
-    # function a( x) = x+3;
-    # */
+    return callables
 
-    # Current implementation would throw an error if you tried to call a(x, y) since Python would
-    # expect a( x);
 
-    # TODO:  write a pyparsing grammar for OpenSCAD, or, even better, use the yacc parse grammar
-    # used by the language itself.  -ETJ 06 Feb 2011
+# ====================================
+# = Builtins that need custom code   =
+# ====================================
+class sphere( openscad_object):
+    __slots__ = ()
 
-    # Also note: this accepts: 'module x(arg) =' and 'function y(arg) {', both of which are incorrect syntax
-    mod_re  = r'(?mxs)^\s*(?:module|function)\s+(?P<callable_name>\w+)\s*\((?P<all_args>.*?)\)\s*(?:{|=)'
+    def __init__( self, r, segments=None):
+        kwargs = { 'r': r, }
+        if segments:
+            kwargs['$fn'] = segments
+        openscad_object.__init__(self, 'sphere', kwargs)
 
-    # This is brittle.  To get a generally applicable expression for all arguments,
-    # we'd need a real parser to handle nested-list default args or parenthesized statements.
-    # For the moment, assume a maximum of one square-bracket-delimited list
-    args_re = r'(?mxs)(?P<arg_name>\w+)(?:\s*=\s*(?P<default_val>[\w-]+|\[.*\]))?(?:,|$)'
+class cylinder( openscad_object):
+    __slots__ = ()
 
+    def __init__( self, r, h, r1=None, center=None, segments=None):
+        kwargs = { 'h': h, 'center': center, }
+        if r1 is not None:
+            kwargs['r'] = r
+            kwargs['r1'] = r1
+        else:
+            kwargs['r'] = r
+        if segments:
+            kwargs['$fn'] = segments
+        openscad_object.__init__(self, 'cylinder', kwargs)
 
-    mod_matches = re.finditer( mod_re, scad_code_str)
+class circle( openscad_object):
+    __slots__ = ()
 
-    for m in mod_matches:
-        callable_name = m.group('callable_name')
-        args = []
-        kwargs = []
-        all_args = m.group('all_args')
-        if all_args:
-            arg_matches = re.finditer( args_re, all_args)
-            for am in arg_matches:
-                arg_name = am.group('arg_name')
-                if am.group('default_val'):
-                    kwargs.append( arg_name)
-                else:
-                    args.append( arg_name)
+    def __init__( self, r, segments=None):
+        if segments:
+            openscad_object.__init__(self, 'circle', {'r': r, '$fn': segments})
+        else:
+            openscad_object.__init__(self, 'circle', {'r': r, })
 
-        callables.append( { 'name':callable_name, 'args': args, 'kwargs':kwargs})
+class polygon( openscad_object):
+    __slots__ = ()
 
-    return callables
+    def __init__( self, points, paths=None):
+        if not paths:
+            paths = [ range( len( points))]
+        openscad_object.__init__( self, 'polygon', {'points':points, 'paths': paths})
 
+# Some functions need custom code in them; their classes are listed here
+builtin_literals = {
+    'sphere':   sphere,
+    'cylinder': cylinder,
+    'circle':   circle,
+    'polygon':  polygon,
+}
 
-# Dynamically add all builtins to this namespace on import
+# Add all other builtins to this namespace on import
 for sym_dict in openscad_builtins:
     # entries in 'builtin_literals' override the entries in 'openscad_builtins'
-    if sym_dict['name'] in builtin_literals:
-        class_str = builtin_literals[ sym_dict['name']]
-    else:
-        class_str = new_openscad_class_str( sym_dict['name'], sym_dict['args'], sym_dict['kwargs'])
-
-    exec class_str
+    if sym_dict['name'] not in builtin_literals:
+        globals()[ sym_dict['name']] = new_openscad_class( sym_dict['name'], sym_dict['args'], sym_dict['kwargs'])
+del sym_dict
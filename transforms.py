@@ -0,0 +1,104 @@
+# NumPy replacements for the Blender matrix helpers the YASim importer was
+# written against.
+#
+# Matrices follow Blender 2.4x's convention: 4x4 matrices that act on row
+# vectors, v * M, with the translation in the last row.  A product A * B
+# therefore applies A first, then B.  Single matrices are np.matrix objects;
+# the batched functions work on N x 3 arrays of vectors and return N x 4 x 4
+# arrays, so that the geometry of many elements is computed at once.
+
+import numpy as np
+
+DEG2RAD = np.pi / 180
+AXES = {'x': 0, 'y': 1, 'z': 2}
+
+
+def translation_matrix(v):
+    """The matrix that moves points by the vector v (Blender's TranslationMatrix)."""
+    m = np.identity(4)
+    m[3, :3] = v[0], v[1], v[2]
+    return np.matrix(m)
+
+def euler_matrices(angles):
+    """The rotations by each row of Euler angles (x, y, z) in an N x 3 array, in
+    degrees: first about the x axis, then about y, then about z."""
+    angles = np.asarray(angles, dtype = float).reshape(-1, 3) * DEG2RAD
+    (ci, cj, ch) = np.cos(angles).T
+    (si, sj, sh) = np.sin(angles).T
+    m = np.zeros((len(angles), 4, 4))
+    m[:, 0, 0] = cj * ch
+    m[:, 0, 1] = cj * sh
+    m[:, 0, 2] = -sj
+    m[:, 1, 0] = sj * si * ch - ci * sh
+    m[:, 1, 1] = sj * si * sh + ci * ch
+    m[:, 1, 2] = cj * si
+    m[:, 2, 0] = sj * ci * ch + si * sh
+    m[:, 2, 1] = sj * ci * sh - si * ch
+    m[:, 2, 2] = cj * ci
+    m[:, 3, 3] = 1
+    return m
+
+def euler_matrix(x, y, z):
+    """The rotation by the Euler angles x, y and z in degrees, see euler_matrices()
+    (Blender's Euler(x, y, z).toMatrix().resize4x4())."""
+    return np.matrix(euler_matrices([x, y, z])[0])
+
+def rotation_matrix(angle, axis):
+    """The rotation by angle degrees about the axis 'x', 'y' or 'z' (Blender's
+    RotationMatrix(angle, 4, axis))."""
+    angles = [0, 0, 0]
+    angles[AXES[axis]] = angle
+    return euler_matrix(*angles)
+
+def normalize(vectors):
+    """Scales each row of an N x 3 array, or a single vector, to length 1.
+    Vectors of length 0 stay as they are."""
+    vectors = np.asarray(vectors, dtype = float)
+    lengths = np.sqrt((vectors * vectors).sum(axis = -1))[..., np.newaxis]
+    return vectors / np.where(lengths == 0, 1, lengths)
+
+def track_matrices(vectors, track = 'x', up = 'z'):
+    """The rotations that turn the track axis into the direction of each row of an
+    N x 3 array, while keeping the up axis as close to the global up axis as
+    possible (Blender's vector.toTrackQuat(track, up).toMatrix()).  Vectors
+    parallel to the up axis turn it towards the remaining axis instead."""
+    (t, u) = (AXES[track], AXES[up])
+    if t == u:
+        raise ValueError("the track and up axes must differ")
+    k = 3 - t - u
+
+    forward = normalize(np.asarray(vectors, dtype = float).reshape(-1, 3))
+    # The global up axis minus its part along the forward direction
+    upward = -forward[:, u, np.newaxis] * forward
+    upward[:, u] += 1
+    parallel = (upward * upward).sum(axis = 1) < 1e-12
+    if parallel.any():
+        upward[parallel] = -forward[parallel, k, np.newaxis] * forward[parallel]
+        upward[parallel, k] += 1
+    upward = normalize(upward)
+
+    m = np.zeros((len(forward), 4, 4))
+    m[:, t, :3] = forward
+    m[:, u, :3] = upward
+    # the remaining axis completes a right-handed frame
+    if (u - t) % 3 == 1:
+        m[:, k, :3] = np.cross(forward, upward)
+    else:
+        m[:, k, :3] = np.cross(upward, forward)
+    m[:, 3, 3] = 1
+    return m
+
+def transform(vectors, matrix, w = 1):
+    """Applies matrix to an N x 3 array of vectors at once and returns the results.
+    w is 1 for points, 0 for directions, which the translation doesn't apply to;
+    it can also be an array holding either for each vector."""
+    vectors = np.asarray(vectors, dtype = float)
+    homogeneous = np.empty((len(vectors), 4))
+    homogeneous[:, :3] = vectors
+    homogeneous[:, 3] = w
+    return homogeneous.dot(np.asarray(matrix))[:, :3]
+
+def scad_matrix(matrix):
+    """matrix as a nested list for OpenSCAD's multmatrix(), which acts on column vectors."""
+    # + 0.0 turns -0.0 into 0.0
+    return (np.asarray(matrix).T + 0.0).tolist()
@@ -51,7 +51,7 @@ It's an unavoidable consequence of how Blender deals with meshes.
 
 Elements are displayed as follows:
 
-  cockpit                             -> monkey head
+  cockpit                             -> not drawn
   fuselage                            -> blue "tube" (with only 12 sides for less clutter); center at "a"
   vstab                               -> red with yellow control surfaces (flap0, flap1, slat, spoiler)
   wing/mstab/hstab                    -> green with yellow control surfaces (which are always 20 cm deep);
@@ -108,21 +108,28 @@ whereby:
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #--------------------------------------------------------------------------------
 
+import os
 import sys
+import glob
 import math
+import time
 import string
-import numpy as np
 from pyopenscad import *
 from xml.sax import handler, make_parser
+try:
+    from xml.parsers import expat
+except ImportError:
+    # read with whatever SAX parser there is instead
+    expat = None
 
-YASIM_MATRIX = np.matrix([[-1, 0, 0, 0], [0, -1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
-ORIGIN = np.array([0, 0, 0])
-X = np.array([1, 0, 0])
-Y = np.array([0, 1, 0])
-Z = np.array([0, 0, 1])
+# numpy takes longer to import than everything else together, so it is only
+# loaded by import_numpy() once there is actually something to convert.
+np = transforms = None
+ORIGIN = X = Y = Z = None
 
 DEG2RAD = math.pi / 180
 RAD2DEG = 180 / math.pi
+LBS2KG = 0.45359237
 
 #NO_EVENT = 0
 #RELOAD_BUTTON = 1
@@ -131,10 +138,21 @@ RAD2DEG = 180 / math.pi
 
 
 
-class Global:
-    path = ""
-    matrix = None
-    data = None
+def import_numpy():
+    global np, transforms, ORIGIN, X, Y, Z
+    if np is not None:
+        return
+
+    import numpy
+    import transforms as transforms_module
+    np = numpy
+    transforms = transforms_module
+    ORIGIN = np.array([0, 0, 0])
+    X = np.array([1, 0, 0])
+    Y = np.array([0, 1, 0])
+    Z = np.array([0, 0, 1])
+
+
 
 class Abort(Exception):
     def __init__(self, msg, term = None):
@@ -143,343 +161,1024 @@ class Abort(Exception):
 
 
 
-def log(msg):
-    print(msg)
-
-
+# Lines and arrows are drawn as thin cylinders along the x axis, which
+# multmatrix() turns and moves into place.  Lengths are in meters, like in
+# YASim files, until they are converted to OpenSCAD's millimeters here.
+
+LINE_RADIUS = 0.002
+
+def line_matrices(starts, ends):
+    """The matrices that turn the x axis into each line from starts to ends (N x 3
+    arrays) and move its origin to the start, in OpenSCAD units; and the lengths."""
+    vectors = ends - starts
+    matrices = transforms.track_matrices(vectors, 'x', 'z')
+    matrices[:, 3, :3] = starts * 1000
+    return (matrices, np.sqrt((vectors * vectors).sum(axis = 1)))
+
+def draw_x_cylinder(start, length, r, r1 = None, segments = None):
+    """A cylinder (a cone if r1 is given) along the x axis, starting at x = start,
+    with segments sides."""
+    mesh = rotate([0, 90, 0])(cylinder(r = r * 1000.0, h = float(length) * 1000, r1 = r1 and r1 * 1000.0, segments = segments))
+    if start:
+        mesh = translate(v = [float(start) * 1000, 0.0, 0.0])(mesh)
+    return mesh
+
+# The faces of a hexahedron whose corners 0-3 go counterclockwise around its
+# bottom, seen from above, and 4-7 around its top in the same order.  They are
+# split into triangles, as twisted surfaces don't have flat sides.
+HEXAHEDRON_QUADS = [[0, 1, 2, 3], [4, 5, 1, 0], [7, 6, 5, 4], [5, 6, 2, 1], [6, 7, 3, 2], [7, 4, 0, 3]]
+HEXAHEDRON_FACES = [[a, b, c] for (a, b, c, d) in HEXAHEDRON_QUADS] + [[a, c, d] for (a, b, c, d) in HEXAHEDRON_QUADS]
+
+def slab_polyhedra(corners, flipped = False):
+    """Polyhedra of an N x 8 x 3 array of hexahedron corners, in OpenSCAD units.
+    flipped is for mirror images, whose faces must be listed the other way round."""
+    faces = HEXAHEDRON_FACES
+    if flipped:
+        faces = [face[::-1] for face in faces]
+    return [polyhedron(points = c, faces = faces) for c in corners.tolist()]
+
+_unit_circles = {}
+
+def unit_circle(segments):
+    """The cosines and sines of segments angles evenly spaced around the circle, a
+    segments x 2 array.  It is computed once for each number of segments and shared
+    by all elements, so don't modify it."""
+    circle = _unit_circles.get(segments)
+    if circle is None:
+        alpha = np.arange(segments) * (2 * np.pi / segments)
+        # rounded, so that cos(90) is 0 rather than 6e-17
+        circle = _unit_circles[segments] = np.round(np.column_stack([np.cos(alpha), np.sin(alpha)]), 15) + 0.0
+    return circle
+
+_tube_faces = {}
+
+def tube_faces(segments, pointed):
+    """The faces of a tube of two sections between three rings of segments points
+    each, which follow each other in its points.  If pointed is set, the first and
+    the last ring are single points instead."""
+    faces = _tube_faces.get((segments, pointed))
+    if faces is None:
+        ring = range(segments)
+        following = ring[1:] + ring[:1]
+        if pointed:
+            (tip0, tip1) = (0, segments + 1)
+            faces = [[tip0, 1 + i, 1 + j] for (i, j) in zip(ring, following)] \
+                    + [[1 + j, 1 + i, tip1] for (i, j) in zip(ring, following)]
+        else:
+            faces = [[r * segments + i, (r + 1) * segments + i, (r + 1) * segments + j, r * segments + j] \
+                    for r in (0, 1) for (i, j) in zip(ring, following)]
+            faces.append(ring)
+            faces.append([2 * segments + i for i in ring[::-1]])
+        _tube_faces[(segments, pointed)] = faces
+    return faces
+
+def loft_faces(rings, sides):
+    """The triangles of a polyhedron lofted through rings of sides points each, which
+    follow each other in its points, closed at the first and the last ring.  The
+    points of each ring go counterclockwise seen from the first ring towards the
+    last, as the corners of a slab do seen from above."""
+    faces = []
+    for r in range(rings - 1):
+        for i in range(sides):
+            (a, b) = (r * sides + i, r * sides + (i + 1) % sides)
+            faces.extend([[a, b + sides, b], [a, a + sides, b + sides]])
+    faces.append(range(sides))
+    faces.append(range((rings - 1) * sides, rings * sides)[::-1])
+    return faces
+
+def draw_lines(starts, ends, segments = None):
+    """Lines from each of starts to the corresponding ends, with segments sides;
+    None for those of length 0."""
+    (matrices, lengths) = line_matrices(starts, ends)
+    lines = []
+    for (matrix, length) in zip(matrices, lengths):
+        if not length:
+            lines.append(None)
+            continue
+        lines.append(multmatrix(transforms.scad_matrix(matrix))(draw_x_cylinder(0, length, LINE_RADIUS, segments = segments)))
+    return lines
 
-def draw_dashed_line(mesh, start, end):
+def draw_dashed_lines(starts, ends, segments = None):
+    """Dashed lines from each of starts to the corresponding ends, with segments
+    sides; None for those of length 0."""
     w = 0.04
-    step = w * (end - start).normalize()
-    n = len(mesh.verts)
-    for i in range(int(1 + 0.5 * (end - start).length / w)):
-        a = start + 2 * i * step
-        b = a + step
-        if (b - end).length < step.length:
-            b = end
-        mesh.verts.extend([a, b])
-        mesh.edges.extend([n + 2 * i, n + 2 * i + 1])
-
-
-
-def draw_arrow(mesh, start, end):
-    v = end - start
-    m = v.toTrackQuat('x', 'z').toMatrix().resize4x4() * TranslationMatrix(start)
-    v = v.length * X
-    n = len(mesh.verts)
-    mesh.verts.extend([ORIGIN * m , v * m, (v - 0.05 * X + 0.05 * Y) * m, (v - 0.05 * X - 0.05 * Y) * m]) # head
-    mesh.verts.extend([(ORIGIN + 0.05 * Y) * m, (ORIGIN - 0.05 * Y) * m]) # base
-    mesh.edges.extend([[n, n + 1], [n + 1, n + 2], [n + 1, n + 3], [n + 4, n + 5]])
-
-
-
-def draw_circle(mesh, numpoints, radius, matrix):
-    n = len(mesh.verts)
-    for i in range(numpoints):
-        angle = 2.0 * math.pi * i / numpoints
-        v = np.array([radius * math.cos(angle), radius * math.sin(angle), 0])
-        mesh.verts.extend([v * matrix])
-    for i in range(numpoints):
-        i1 = (i + 1) % numpoints
-        mesh.edges.extend([[n + i, n + i1]])
+    (matrices, lengths) = line_matrices(starts, ends)
+    lines = []
+    for (matrix, length) in zip(matrices, lengths):
+        if not length:
+            lines.append(None)
+            continue
+        dashes = [draw_x_cylinder(2 * i * w, min(w, length - 2 * i * w), LINE_RADIUS, segments = segments) for i in range(int(1 + 0.5 * length / w))]
+        lines.append(multmatrix(transforms.scad_matrix(matrix))(*dashes))
+    return lines
+
+def draw_t_lines(roots, tips, axes, segments = None):
+    """Lines from each of roots to the corresponding tips, with a bar of 10 cm
+    across each tip along the y axis of axes (see model_axes); None for lines of
+    length 0."""
+    bar = 0.05 * axes[1]
+    return [line and union()(line, bar_line) for (line, bar_line) \
+            in zip(draw_lines(roots, tips, segments), draw_lines(tips - bar, tips + bar, segments))]
+
+def model_axes(converter):
+    """The YASim x, y and z axes in the scene, as the rows of a 3 x 3 array."""
+    if converter.matrix is None:
+        return np.identity(3)
+    return np.asarray(converter.matrix)[:3, :3]
+
+def background_parts(rgba, *parts):
+    """The parts that aren't None in one color, as background; None if there are
+    none."""
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return None
+    return color(rgba)(*parts).set_modifier('background')
+
+def angled(origins, length, angles, axes, sign = 1):
+    """The points length away from each of origins, sign times backwards along the
+    x axis of axes and downwards by angles in degrees, as hooks and launchbars
+    are drawn."""
+    angles = angles * DEG2RAD
+    return origins - length[:, np.newaxis] * (sign * np.cos(angles)[:, np.newaxis] * axes[0] + np.sin(angles)[:, np.newaxis] * axes[2])
+
+def draw_arrows(starts, ends, segments = None):
+    """Arrows from each of starts to the corresponding ends, with segments sides."""
+    head = 0.05
+    (matrices, lengths) = line_matrices(starts, ends)
+    arrows = []
+    for (matrix, length) in zip(matrices, lengths):
+        shaft = max(length - head, 0)
+        arrows.append(multmatrix(transforms.scad_matrix(matrix))(
+                draw_x_cylinder(0, shaft, LINE_RADIUS, segments = segments),
+                draw_x_cylinder(shaft, length - shaft, 0, head, segments)))
+    return arrows
+
+
+
+def mass_properties(positions, masses):
+    """The total mass, the center of gravity and the inertia tensor about it of point
+    masses at positions, an N x 3 array, for each row of masses, an L x N array of
+    loadings (or a single loading of N masses).  Returns arrays of L masses, L x 3
+    CGs and L x 3 x 3 tensors; the CG of a loading without mass is the origin."""
+    import_numpy()
+    masses = np.asarray(masses, dtype = float)
+    if masses.ndim == 1:
+        masses = masses[np.newaxis]
+    total = masses.sum(axis = 1)
+    cg = masses.dot(positions) / np.where(total == 0, 1, total)[:, np.newaxis]
+    # The tensor about the origin, moved to the CG by the parallel axis theorem:
+    # sum(m (|r|^2 E - r r^T)) - M (|cg|^2 E - cg cg^T), with all sums over the
+    # point masses done as one matrix product per term
+    second = masses.dot((positions[:, :, np.newaxis] * positions[:, np.newaxis, :]).reshape(-1, 9)).reshape(-1, 3, 3)
+    second -= total[:, np.newaxis, np.newaxis] * cg[:, :, np.newaxis] * cg[:, np.newaxis, :]
+    trace = second[:, 0, 0] + second[:, 1, 1] + second[:, 2, 2]
+    inertia = trace[:, np.newaxis, np.newaxis] * np.identity(3) - second
+    return (total, cg, inertia)
+
+def mass_report(total, cg, inertia):
+    """The mass properties of one loading, see mass_properties, as text."""
+    lines = ["mass %.3f kg" % total, "CG x=%.4f y=%.4f z=%.4f m" % tuple(cg), "inertia about the CG (kg m^2):"]
+    lines.extend("    %12.5f %12.5f %12.5f" % tuple(row) for row in inertia)
+    return "\n".join(lines)
+
+def draw_cg_marker(cg, segments):
+    """A ball with bars along the three axes at cg, in meters."""
+    return translate(v = [float(c) * 1000 for c in cg])(
+            color([0.1, 0.1, 0.1, 0.8])(sphere(25, segments = segments)),
+            color([1.0, 1.0, 1.0, 0.8])(cube([150, 4, 4], center = True), cube([4, 150, 4], center = True), \
+            cube([4, 4, 150], center = True))).set_modifier('background')
+
+
+
+class LevelOfDetail:
+    """How finely round shapes are drawn: the $fn of cylinders and spheres, and the
+    sides of tubes and discs.  A shape gets about one side per edge millimeters of
+    its circumference, times detail, but at least and at most the limits of its
+    kind; the maximum grows with detail too.
+
+    With a facet_budget, YASimConverter lowers scale, which multiplies detail,
+    until the scene has at most that many facets (see pyopenscad.count_facets),
+    or until all shapes are at the minimum of their kind."""
+    # (minimum, maximum) sides of lines and arrows, of the markers of tanks,
+    # ballast and weights, of fuselage tubes and of rotor and propeller discs
+    limits = {"line": (4, 8), "marker": (8, 32), "tube": (6, 48), "disc": (16, 128)}
+    edge = 10.0
+
+    def __init__(self, detail = 1.0, facet_budget = None):
+        self.detail = detail
+        self.facet_budget = facet_budget
+        self.reset()
+
+    def reset(self):
+        self.scale = 1.0
+        # set once lowering scale no longer removes facets
+        self.lowest = False
+
+    def segments(self, kind, r):
+        """The sides of a shape of the given kind and radius r in OpenSCAD units;
+        for an array of radii, an array of sides."""
+        (low, high) = self.limits[kind]
+        factor = self.detail * self.scale
+        sides = np.clip(np.round(factor * 2 * np.pi * np.asarray(r) / self.edge), low, max(low, int(high * factor)))
+        if sides.ndim:
+            return sides.astype(int)
+        return int(sides)
+
+
+
+class ElementTable:
+    """All elements of one kind (one tag) of a YASim file, in file order.  While the
+    file is read, each element is a row list; once it has been read, array holds all
+    of them in a NumPy structured array with the fields of the kind's Item."""
+
+    def __init__(self, kind, item):
+        self.kind = kind
+        self.item = item
+        self.dtype = np.dtype(item.fields)
+        self.names = self.dtype.names
+        self.rows = []
+        self.seq = []
+        self._array = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, seq, row):
+        self.rows.append(list(row))
+        self.seq.append(seq)
+        self._array = None
+        return len(self.rows) - 1
+
+    def set(self, index, field, value):
+        self.rows[index][self.names.index(field)] = value
+        self._array = None
+
+    def get(self, index, field):
+        return self.rows[index][self.names.index(field)]
+
+    def name(self, index):
+        return "YASim_%s#%d" % (self.kind, index)
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.array([tuple(row) for row in self.rows], dtype = self.dtype)
+        return self._array
+
+
+
+class ElementStore:
+    """The elements of a YASim file, one ElementTable per kind.  seq numbers the
+    elements across all tables in file order."""
+
+    def __init__(self):
+        self.tables = {}
+        self.seq = 0
+
+    def add(self, kind, row):
+        """Appends an element of the given kind (see element_handler) and returns
+        a reference to it, a (table, index) tuple."""
+        table = self.tables.get(kind)
+        if table is None:
+            table = self.tables[kind] = ElementTable(kind, element_items[kind])
+        self.seq += 1
+        return (table, table.append(self.seq, row))
+
+    def table(self, kind):
+        """The table of the given kind, or None if there are no such elements."""
+        return self.tables.get(kind)
+
+    def kinds(self, item_class):
+        """The tables whose Item is an instance of item_class, e.g. of all wings and
+        stabs."""
+        return [t for t in self.tables.values() if isinstance(t.item, item_class)]
+
+    def reset(self):
+        """Undoes transform() and override(): the arrays of all tables are built from
+        the elements as read again."""
+        for table in self.tables.values():
+            table._array = None
+
+    def override(self, key, value):
+        """Sets a field of elements to value (until reset()).  key is 'kind#index.field'
+        for one element, e.g. 'ballast#2.mass', or 'kind.field' for all elements of a
+        kind; a 3D field's x, y or z component is set with e.g. 'propeller#0.center.x'.
+        Fields are named as in the kind's Item.  Raises Abort if there is no such
+        element or field."""
+        (element, dot, field) = key.partition(".")
+        (kind, sharp, index) = element.partition("#")
+        (field, dot, component) = field.partition(".")
+        table = self.tables.get(kind)
+        if table is None or field not in table.names:
+            raise Abort("%s: no %s element has a field named '%s'" % (key, kind, field))
+        values = table.array[field]
+        if index:
+            if not index.isdigit() or int(index) >= len(table):
+                raise Abort("%s: there are only %d %s elements" % (key, len(table), kind))
+            values = values[int(index):int(index) + 1]
+        if component:
+            if values.ndim != 2 or component not in transforms.AXES:
+                raise Abort("%s: %s isn't a component of the %s field" % (key, component, field))
+            values = values[:, transforms.AXES[component]]
+        values[...] = value
+
+    def transform(self, matrix):
+        """Moves all elements into another frame: applies the 4x4 matrix to the point
+        fields of all tables, and without its translation to their direction fields,
+        in a single matrix product."""
+        columns = []
+        for table in self.tables.values():
+            records = table.array
+            columns.extend([(records, field, 1) for field in table.item.points])
+            columns.extend([(records, field, 0) for field in table.item.directions])
+        if not columns:
+            return
+
+        vectors = np.concatenate([records[field] for (records, field, w) in columns])
+        w = np.concatenate([np.repeat(w, len(records)) for (records, field, w) in columns])
+        vectors = transforms.transform(vectors, matrix, w)
+        start = 0
+        for (records, field, w) in columns:
+            records[field] = vectors[start:start + len(records)]
+            start += len(records)
 
 
 
 class Item:
-    scene = union()
+    """Describes one kind of YASim element: the fields its elements are stored with,
+    as NumPy (name, type[, shape]) tuples, and how they are built.  points and
+    directions name the fields that hold 3D points and directions, which are
+    transformed when the elements are moved into model space."""
+    fields = []
+    points = ()
+    directions = ()
+
+    def build(self, records, converter):
+        """Returns a list with the OpenSCAD geometry of each of records, an array of
+        elements of this kind, or None for elements that aren't drawn.  converter is
+        the YASimConverter, whose settings and matrix apply."""
+        return [None] * len(records)
+
+    def clearance_shapes(self, records, names):
+        """For elements that take up space others must keep clear of: a list with the
+        clearance.Shape of each of records, named after names; None for elements
+        that aren't checked."""
+        return None
 
-    def make_twosided(self, mesh):
-        pass
-        #mesh.faceUV = True
-        #for f in mesh.faces:
-        #    f.mode |= Blender.Mesh.FaceModes.TWOSIDE | Blender.Mesh.FaceModes.OBCOL
+    def point_masses(self, records, loadings):
+        """For elements that are point masses at their center field: the mass in kg
+        of each of records (all elements of this kind, in file order) under each of
+        loadings, an L x N array, see YASimConverter.mass_properties.  None for
+        elements without mass."""
+        return None
 
 class Cockpit(Item):
-    def __init__(self, center):
-        '''    mesh = Blender.Mesh.Primitives.Monkey()
-        mesh.transform(ScaleMatrix(0.13, 4) * Euler(90, 0, 90).toMatrix().resize4x4() * TranslationMatrix(np.array([-0.1, 0, -0.032)))
-        obj = self.scene.objects.new(mesh, "YASim_cockpit")
-        obj.setMatrix(TranslationMatrix(center) * Global.matrix)
-        '''
-
-    def set_color(self, obj, color):
-        return
-
-        '''
-        mat = Blender.Material.New()
-        mat.setRGBCol(color[0], color[1], color[2])
-        mat.setAlpha(color[3])
-        mat.mode |= Blender.Material.Modes.ZTRANSP | Blender.Material.Modes.TRANSPSHADOW
-        obj.transp = True
-
-        mesh = obj.getData(mesh = True)
-        mesh.materials += [mat]
-
-        for f in mesh.faces:
-            f.smooth = True
-        mesh.calcNormals()
-        '''
+    """The pilot's eyepoint, which isn't drawn."""
+    fields = [("center", "f8", 3)]
+    points = ("center",)
 
 
 class Tank(Item):
-    def __init__(self, name, center):
-        mesh = translate(v = [center[0]*1000, center[1]*1000, center[2]*1000])(     ## convert YASim meters to OpenSCAD milimeters
-        color([0.3, 0.3, 0.9, 0.5])(cube(size=20, center = True )),
-        sphere(15))
-        #mesh.translate()(mesh)
-        mesh.set_modifier('background')
-        Item.scene.add(mesh)
+    """Tanks are full unless a loading sets the FlightGear property of their level."""
+    fields = [("center", "f8", 3), ("capacity", "f8")]
+    points = ("center",)
+    level_property = "/consumables/fuel/tank[%d]/level-kg"
+
+    def point_masses(self, records, loadings):
+        masses = np.empty((len(loadings), len(records)))
+        for (l, loading) in enumerate(loadings):
+            masses[l] = [loading.get(self.level_property % i, capacity) for (i, capacity) in enumerate(records["capacity"])]
+        return masses
+
+    def build(self, records, converter):
+        meshes = []
+        for center in records["center"] * 1000:     ## convert YASim meters to OpenSCAD milimeters
+            mesh = translate(v = list(center))(
+            color([0.3, 0.3, 0.9, 0.5])(cube(size=20, center = True )),
+            sphere(15, segments = converter.lod.segments("marker", 15)))
+            mesh.set_modifier('background')
+            meshes.append(mesh)
+        return meshes
 
 class Ballast(Item):
-    def __init__(self, name, center, mass):
-        mesh = translate(v = [center[0]*1000, center[1]*1000, center[2]*1000])(
-        color([0.3, 0.5, 0.9, 0.5])(cylinder(h=mass*50, r=20, center = True )))     ## multiply mass by arbitrary value to visualise it.
-        #mesh.translate()(mesh)
-        mesh.set_modifier('background')
-        Item.scene.add(mesh)
-
-class Weight(Item):
-    def __init__(self, name, center):
-        mesh = translate(v = [center[0]*1000, center[1]*1000, center[2]*1000])(
-        color([0.3, 0.4, 0.9, 0.5])(cylinder(h=50, r=20, center = True )))
-        #mesh.translate()(mesh)
-        mesh.set_modifier('background')
-        Item.scene.add(mesh)
-
-class Gear(Item):
-    def __init__(self, name, center, compression):
-        '''    mesh = Blender.Mesh.New()
-        mesh.verts.extend([ORIGIN, compression])
-        mesh.edges.extend([0, 1])
-        obj = self.scene.objects.new(mesh, name)
-        obj.setMatrix(TranslationMatrix(center) * Global.matrix)
-        '''
-
-class Hook(Item):
-    def __init__(self, name, center, length, up_angle, dn_angle):
-        '''    mesh = Blender.Mesh.New()
-        up = ORIGIN - length * math.cos(up_angle * DEG2RAD) * X - length * math.sin(up_angle * DEG2RAD) * Z
-        dn = ORIGIN - length * math.cos(dn_angle * DEG2RAD) * X - length * math.sin(dn_angle * DEG2RAD) * Z
-        mesh.verts.extend([ORIGIN, dn, dn + 0.05 * Y, dn - 0.05 * Y])
-        mesh.edges.extend([[0, 1], [2, 3]])
-        draw_dashed_line(mesh, ORIGIN, up)
-        draw_dashed_line(mesh, ORIGIN, dn)
-        obj = self.scene.objects.new(mesh, name)
-        obj.setMatrix(TranslationMatrix(center) * Global.matrix)
-        '''
-
-
-class Launchbar(Item):
-    def __init__(self, name, lb, lb_length, hb, hb_length, up_angle, dn_angle):
-        '''    mesh = Blender.Mesh.New()
-        hb = hb - lb
-        lb_tip = ORIGIN + lb_length * math.cos(dn_angle * DEG2RAD) * X - lb_length * math.sin(dn_angle * DEG2RAD) * Z
-        hb_tip = hb - hb_length * math.cos(dn_angle * DEG2RAD) * X - hb_length * math.sin(dn_angle * DEG2RAD) * Z
-        mesh.verts.extend([lb_tip, ORIGIN, hb, hb_tip, lb_tip + 0.05 * Y, lb_tip - 0.05 * Y, hb_tip + 0.05 * Y, hb_tip - 0.05 * Y])
-        mesh.edges.extend([[0, 1], [1, 2], [2, 3], [4, 5], [6, 7]])
-        draw_dashed_line(mesh, ORIGIN, lb_length * math.cos(up_angle * DEG2RAD) * X - lb_length * math.sin(up_angle * DEG2RAD) * Z)
-        draw_dashed_line(mesh, hb, hb - hb_length * math.cos(up_angle * DEG2RAD) * X - hb_length * math.sin(up_angle * DEG2RAD) * Z)
-        obj = self.scene.objects.new(mesh, name)
-        obj.setMatrix(TranslationMatrix(lb) * Global.matrix)
-        '''
-
-class Hitch(Item):
-    def __init__(self, name, center):
-        '''        mesh = Blender.Mesh.Primitives.Circle(6, 0.1)
-        obj = self.scene.objects.new(mesh, name)
-        obj.setMatrix(RotationMatrix(90, 4, "x") * TranslationMatrix(center) * Global.matrix)
-
-        '''
-
-class Thrust:
-    def set_actionpt(self, p):
-        self.actionpt = p
+    fields = [("center", "f8", 3), ("mass", "f8")]
+    points = ("center",)
 
-    def set_dir(self, d):
-        self.thrustvector = d
+    def point_masses(self, records, loadings):
+        return np.tile(records["mass"], (len(loadings), 1))
 
+    def build(self, records, converter):
+        meshes = []
+        for (center, height) in zip(records["center"] * 1000, records["mass"] * 50):     ## multiply mass by arbitrary value to visualise it.
+            mesh = translate(v = list(center))(
+            color([0.3, 0.5, 0.9, 0.5])(cylinder(h=float(height), r=20, center = True, segments = converter.lod.segments("marker", 20))))
+            mesh.set_modifier('background')
+            meshes.append(mesh)
+        return meshes
 
+class Weight(Item):
+    """Weights get their mass from the FlightGear property named by mass_prop, as set
+    by a loading; 0 if it isn't set."""
+    fields = [("center", "f8", 3), ("mass_prop", "S128")]
+    points = ("center",)
+
+    def point_masses(self, records, loadings):
+        # Look each property up once per loading, however many weights use it
+        (props, which) = np.unique(records["mass_prop"], return_inverse = True)
+        masses = np.array([[loading.get(prop, 0.0) for prop in props] for loading in loadings], dtype = float)
+        return masses[:, which]
+
+    def build(self, records, converter):
+        meshes = []
+        for center in records["center"] * 1000:
+            mesh = translate(v = list(center))(
+            color([0.3, 0.4, 0.9, 0.5])(cylinder(h=50, r=20, center = True, segments = converter.lod.segments("marker", 20))))
+            mesh.set_modifier('background')
+            meshes.append(mesh)
+        return meshes
 
-class Thruster(Thrust, Item):
-    def __init__(self, name, center, thrustvector):
-        (self.name, self.center, self.actionpt, self.thrustvector) = (name, center, center, thrustvector)
-
-    def __del__(self):
-        '''        a = self.actionpt - self.center
-        mesh = Blender.Mesh.New()
-        draw_dashed_line(mesh, ORIGIN, a)
-        draw_arrow(mesh, a, a + self.thrustvector.normalize())
-        obj = self.scene.objects.new(mesh, self.name)
-        obj.setMatrix(TranslationMatrix(self.center) * Global.matrix)
-        '''
-
-
-class Propeller(Thrust, Item):
-    def __init__(self, name, center, radius):
-        (self.name, self.center, self.radius, self.actionpt, self.thrustvector) = (name, center, radius, center, -X)
-    #    print(radius)
+class Gear(Item):
+    fields = [("center", "f8", 3), ("compression", "f8", 3)]
+    points = ("center",)
+    directions = ("compression",)
 
-    def __del__(self):
-        mesh = translate(v = [self.center[0]*1000, self.center[1]*1000, self.center[2]*1000])(
-        rotate([0,90,0])(
-        color([0.5, 0.4, 0.9, 0.5])
-        (cylinder(h=2, r=self.radius*1000, center = True )))
-        )
-        mesh.set_modifier('background')
-        Item.scene.add(mesh)
+    def clearance_shapes(self, records, names):
+        # the contact point
+        import clearance
+        return [clearance.Point(name, center) for (name, center) in zip(names, records["center"])]
 
-        '''        a = self.actionpt - self.center
-        matrix = self.thrustvector.toTrackQuat('z', 'x').toMatrix().resize4x4() * TranslationMatrix(a)
+    def build(self, records, converter):
+        """A line from the contact point along the compression vector."""
+        centers = records["center"]
+        lines = draw_lines(centers, centers + records["compression"], converter.lod.segments("line", LINE_RADIUS * 1000))
+        return [background_parts([0.2, 0.2, 0.2, 0.8], line) for line in lines]
 
-        mesh = Blender.Mesh.New()
-        mesh.verts.extend([ORIGIN * matrix, (ORIGIN + self.radius * X) * matrix])
-        mesh.edges.extend([[0, 1]])
-        draw_dashed_line(mesh, ORIGIN, a)
-        draw_arrow(mesh, a, a + self.thrustvector.normalize())
+class Hook(Item):
+    fields = [("center", "f8", 3), ("length", "f8"), ("up_angle", "f8"), ("dn_angle", "f8")]
+    points = ("center",)
 
-        draw_circle(mesh, 128, self.radius, matrix)
-        obj = self.scene.objects.new(mesh, self.name)
-        obj.setMatrix(TranslationMatrix(self.center) * Global.matrix)
-        '''
+    def build(self, records, converter):
+        """The hook backwards from its center: a dashed line at the up angle, and a
+        line with a bar across its tip at the down angle."""
+        axes = model_axes(converter)
+        (centers, length) = (records["center"], records["length"])
+        ups = angled(centers, length, records["up_angle"], axes)
+        downs = angled(centers, length, records["dn_angle"], axes)
+        segments = converter.lod.segments("line", LINE_RADIUS * 1000)
+        return [background_parts([0.9, 0.6, 0.1, 0.8], up, down) for (up, down) \
+                in zip(draw_dashed_lines(centers, ups, segments), draw_t_lines(centers, downs, axes, segments))]
 
 
-class Jet(Thrust, Item):
-    def __init__(self, name, center, rotate):
-        (self.name, self.center, self.actionpt) = (name, center, center)
-        self.thrustvector = -X * RotationMatrix(rotate, 4, "y")
+class Launchbar(Item):
+    fields = [("lb", "f8", 3), ("lb_length", "f8"), ("hb", "f8", 3), ("hb_length", "f8"), ("up_angle", "f8"), ("dn_angle", "f8")]
+    points = ("lb", "hb")
+
+    def build(self, records, converter):
+        """A line from the launchbar to the holdback; the launchbar forwards and the
+        holdback backwards from there, each as a dashed line at the up angle, and
+        a line with a bar across its tip at the down angle."""
+        axes = model_axes(converter)
+        (lb, hb, lb_length, hb_length) = (records["lb"], records["hb"], records["lb_length"], records["hb_length"])
+        (up, down) = (records["up_angle"], records["dn_angle"])
+        segments = converter.lod.segments("line", LINE_RADIUS * 1000)
+        parts = [draw_lines(lb, hb, segments),
+                draw_dashed_lines(lb, angled(lb, lb_length, up, axes, -1), segments),
+                draw_t_lines(lb, angled(lb, lb_length, down, axes, -1), axes, segments),
+                draw_dashed_lines(hb, angled(hb, hb_length, up, axes), segments),
+                draw_t_lines(hb, angled(hb, hb_length, down, axes), axes, segments)]
+        return [background_parts([0.9, 0.6, 0.1, 0.8], *element) for element in zip(*parts)]
 
-    def __del__(self):
-        '''        a = self.actionpt - self.center
-        mesh = Blender.Mesh.New()
-        draw_dashed_line(mesh, ORIGIN, a)
-        draw_arrow(mesh, a, a + self.thrustvector.normalize())
-        obj = self.scene.objects.new(mesh, self.name)
-        obj.setMatrix(TranslationMatrix(self.center) * Global.matrix)
-        '''
+class Hitch(Item):
+    fields = [("center", "f8", 3)]
+    points = ("center",)
+
+    def clearance_shapes(self, records, names):
+        import clearance
+        return [clearance.Point(name, center) for (name, center) in zip(names, records["center"])]
+
+    def build(self, records, converter):
+        """Hexagons of 10 cm across, upright and facing sideways."""
+        axes = model_axes(converter)
+        # the hexagon's axis, z, along the YASim y axis
+        frame = np.identity(4)
+        frame[:3, :3] = [axes[0], axes[2], -axes[1]]
+        hexagon = cylinder(r = 50, h = 2 * LINE_RADIUS * 1000, center = True, segments = 6)
+        meshes = []
+        for center in records["center"] * 1000:
+            frame[3, :3] = center
+            meshes.append(background_parts([0.6, 0.3, 0.1, 0.8], multmatrix(transforms.scad_matrix(frame))(hexagon.copy())))
+        return meshes
+
+class Thrust(Item):
+    """Thrusters, propellers and jets; their <actionpt> and <dir> child elements
+    set actionpt and thrustvector, which default to the center and the item's
+    own direction."""
+    fields = [("center", "f8", 3), ("actionpt", "f8", 3), ("thrustvector", "f8", 3)]
+    points = ("center", "actionpt")
+    directions = ("thrustvector",)
+
+    def build(self, records, converter):
+        """A dashed line from the center to the action point, and an arrow of 1 m
+        from there in the direction of the thrust."""
+        (centers, actionpts) = (records["center"], records["actionpt"])
+        segments = converter.lod.segments("line", LINE_RADIUS * 1000)
+        lines = draw_dashed_lines(centers, actionpts, segments)
+        arrows = draw_arrows(actionpts, actionpts + transforms.normalize(records["thrustvector"]), segments)
+        meshes = []
+        for (line, arrow) in zip(lines, arrows):
+            mesh = color([0.9, 0.4, 0.3, 0.5])(arrow)
+            if line is not None:
+                mesh.add(line)
+            mesh.set_modifier('background')
+            meshes.append(mesh)
+        return meshes
+
+
+
+class Thruster(Thrust):
+    pass
+
+
+class Propeller(Thrust):
+    fields = Thrust.fields + [("radius", "f8")]
+
+    def clearance_shapes(self, records, names):
+        import clearance
+        return [clearance.Disc(name, center, normal, radius) for (name, center, normal, radius) \
+                in zip(names, records["center"], records["thrustvector"], records["radius"])]
+
+    def build(self, records, converter):
+        """The thrust line and arrow of Thrust.build, and the propeller disc at the
+        center, at right angles to the thrust vector like the clearance_shapes disc:
+
+        >>> import tempfile
+        >>> (fd, path) = tempfile.mkstemp(".xml")
+        >>> f = os.fdopen(fd, "w")
+        >>> f.write('<airplane><propeller x="1" y="0" z="0" radius="0.5"><dir x="0" y="1" z="1"/></propeller></airplane>')
+        >>> f.close()
+        >>> converter = YASimConverter(verbose = False)
+        >>> converter.read(path)
+        >>> table = converter.elements.table("propeller")
+        >>> disc = table.item.clearance_shapes(table.array, ["propeller"])[0]
+        >>> import numpy
+        >>> frame = numpy.array(table.item.build(table.array, converter)[0].children[-1].params["m"])
+        >>> numpy.allclose(frame[:3, 2], disc.normal)
+        True
+        >>> os.remove(path)
+        """
+        # Disc frame: z along the thrust vector
+        frames = transforms.track_matrices(records["thrustvector"], 'z', 'x')
+        frames[:, 3, :3] = records["center"] * 1000
+        meshes = []
+        for (thrust, frame, radius) in zip(Thrust.build(self, records, converter), frames, records["radius"] * 1000):
+            disc = multmatrix(transforms.scad_matrix(frame))(
+            color([0.5, 0.4, 0.9, 0.5])
+            (cylinder(h=2, r=float(radius), center = True, segments = converter.lod.segments("disc", radius))))
+            mesh = union()(thrust, disc)
+            mesh.set_modifier('background')
+            meshes.append(mesh)
+        return meshes
+
+
+class Jet(Thrust):
+    fields = Thrust.fields + [("rotate", "f8")]
 
 
 class Fuselage(Item):
-    def __init__(self, name, a, b, width, taper, midpoint):
-        '''        numvert = 12
-        angle = []
-        for i in range(numvert):
-            alpha = i * 2 * math.pi / float(numvert)
-            angle.append([math.cos(alpha), math.sin(alpha)])
-
+    fields = [("a", "f8", 3), ("b", "f8", 3), ("width", "f8"), ("taper", "f8"), ("midpoint", "f8")]
+    points = ("a", "b")
+
+    def clearance_shapes(self, records, names):
+        import clearance
+        return [clearance.Tube(name, r["a"], r["b"], 0.5 * r["width"] * np.array([r["taper"], 1, r["taper"]]), r["midpoint"]) \
+                for (name, r) in zip(names, records)]
+
+    def build(self, records, converter):
+        """Tubes whose width tapers from the midpoint to taper times the width at
+        both ends; ends tapered to nothing are drawn as points rather than rings.
+        They have converter.fuselage_segments sides, or as many as the level of
+        detail gives them; all tubes with the same number of sides are computed
+        at once."""
+        n = len(records)
+        if not n:
+            return []
+        if converter.fuselage_segments:
+            sides = np.repeat(converter.fuselage_segments, n)
+        else:
+            sides = converter.lod.segments("tube", 500 * records["width"])
+        meshes = [None] * n
+        for segments in np.unique(sides):
+            which = np.flatnonzero(sides == segments)
+            for (i, mesh) in zip(which, self.build_tubes(records[which], int(segments))):
+                meshes[i] = mesh
+        return meshes
+
+    def build_tubes(self, records, segments):
+        n = len(records)
+        (a, b, width, taper) = (records["a"], records["b"], records["width"], records["taper"])
         axis = b - a
-        length = axis.length
-        mesh = Blender.Mesh.New()
-
-        for i in range(numvert):
-            mesh.verts.extend([[0, 0.5 * width * taper * angle[i][0], 0.5 * width * taper * angle[i][1]]])
-        for i in range(numvert):
-            mesh.verts.extend([[midpoint * length, 0.5 * width * angle[i][0], 0.5 * width * angle[i][1]]])
-        for i in range(numvert):
-            mesh.verts.extend([[length, 0.5 * width * taper * angle[i][0], 0.5 * width * taper * angle[i][1]]])
-        for i in range(numvert):
-            i1 = (i + 1) % numvert
-            mesh.faces.extend([[i, i1, i1 + numvert, i + numvert]])
-            mesh.faces.extend([[i + numvert, i1 + numvert, i1 + 2 * numvert, i + 2 * numvert]])
-
-        mesh.verts.extend([ORIGIN, length * X])
-        obj = self.scene.objects.new(mesh, name)
-        obj.setMatrix(axis.toTrackQuat('x', 'y').toMatrix().resize4x4() * TranslationMatrix(a) * Global.matrix)
-        self.set_color(obj, [0, 0, 0.5, 0.4])
-        '''
+        length = np.sqrt((axis * axis).sum(axis = 1))
+
+        # Tube frame: x along the axis from a to b.  The rings at a, at the
+        # midpoint and at b, N x 3 x segments x 3.
+        radii = 0.5 * width[:, np.newaxis] * np.column_stack([taper, np.ones(n), taper])
+        rings = np.empty((n, 3, segments, 3))
+        stations = length[:, np.newaxis] * np.column_stack([np.zeros(n), records["midpoint"], np.ones(n)])
+        rings[..., 0] = stations[..., np.newaxis]
+        rings[..., 1:] = radii[..., np.newaxis, np.newaxis] * unit_circle(segments)
+        rotations = transforms.track_matrices(axis, 'x', 'y')[:, :3, :3]
+        points = np.einsum('nrsi,nij->nrsj', rings, rotations)
+        points += a[:, np.newaxis, np.newaxis]
+        points *= 1000
+        points += 0.0
+
+        meshes = []
+        for (p, pointed) in zip(points.tolist(), taper == 0):
+            if pointed:
+                (p, faces) = ([p[0][0]] + p[1] + [p[2][0]], tube_faces(segments, True))
+            else:
+                (p, faces) = (p[0] + p[1] + p[2], tube_faces(segments, False))
+            mesh = color([0, 0, 0.5, 0.4])(polyhedron(points = p, faces = faces))
+            mesh.set_modifier('background')
+            meshes.append(mesh)
+        return meshes
 
 
 class Rotor(Item):
-    def __init__(self, name, center, up, fwd, numblades, radius, chord, twist, taper, rel_len_blade_start, phi0, ccw):
-        mesh = translate(v = [center[0]*1000, center[1]*1000, center[2]*1000])(
-        color([0.6, 0.4, 0.9, 0.5])
-        (cylinder(h=2, r=radius*1000, center = True )))
-        mesh.set_modifier('background')
-        Item.scene.add(mesh)
-
-        '''        matrix = RotationMatrix(phi0, 4, "z") * up.toTrackQuat('z', 'x').toMatrix().resize4x4()
-        invert = matrix.copy().invert()
-        direction = [-1, 1][ccw]
-        twist *= DEG2RAD
-        a = ORIGIN + rel_len_blade_start * radius * X
-        b = ORIGIN + radius * X
-        tw = 0.5 * chord * taper * math.cos(twist) * Y + 0.5 * direction * chord * taper * math.sin(twist) * Z
-
-        mesh = Blender.Mesh.New()
-        mesh.verts.extend([ORIGIN, a, b, a + 0.5 * chord * Y, a - 0.5 * chord * Y, b + tw, b - tw])
-        mesh.edges.extend([[0, 1], [1, 2], [1, 3], [1, 4], [3, 5], [4, 6], [5, 6]])
-        draw_circle(mesh, 64, rel_len_blade_start * radius, Matrix())
-        draw_circle(mesh, 128, radius, Matrix())
-        draw_arrow(mesh, ORIGIN, up * invert)
-        draw_arrow(mesh, ORIGIN, fwd * invert)
-        b += 0.1 * X + direction * chord * Y
-        draw_arrow(mesh, b, b + min(0.5 * radius, 1) * direction * Y)
-        obj = self.scene.objects.new(mesh, name)
-        obj.setMatrix(matrix * TranslationMatrix(center) * Global.matrix)
-        '''
-
-
-class Wing(Item):
-    def __init__(self, name, root, length, chord, incidence, twist, taper, sweep, dihedral):
-        '''        #  <1--0--2
-        #   \  |  /
-        #    4-3-5
-        self.is_symmetric = not name.startswith("YASim_vstab#")
-        mesh = Blender.Mesh.New()
-        mesh.verts.extend([ORIGIN, ORIGIN + 0.5 * chord * X, ORIGIN - 0.5 * chord * X])
-        tip = ORIGIN + math.cos(sweep * DEG2RAD) * length * Y - math.sin(sweep * DEG2RAD) * length * X
-        tipfore = tip + 0.5 * taper * chord * math.cos(twist * DEG2RAD) * X + 0.5 * taper * chord * math.sin(twist * DEG2RAD) * Z
-        tipaft = tip + tip - tipfore
-        mesh.verts.extend([tip, tipfore, tipaft])
-        mesh.faces.extend([[0, 1, 4, 3], [2, 0, 3, 5]])
-
-        self.make_twosided(mesh)
-
-        obj = self.scene.objects.new(mesh, name)
-        mesh.transform(Euler(dihedral, -incidence, 0).toMatrix().resize4x4())
-        self.set_color(obj, [[0.5, 0.0, 0, 0.5], [0.0, 0.5, 0, 0.5]][self.is_symmetric])
-        (self.obj, self.mesh) = (obj, mesh)
-
-        if self.is_symmetric and Global.mirror_button.val:
-            mod = obj.modifiers.append(Blender.Modifier.Type.MIRROR)
-            mod[Blender.Modifier.Settings.AXIS_X] = False
-            mod[Blender.Modifier.Settings.AXIS_Y] = True
-            mod[Blender.Modifier.Settings.AXIS_Z] = False
-            mesh.transform(TranslationMatrix(root)) # must move object center to x axis
-            obj.setMatrix(Global.matrix)
+    fields = [("center", "f8", 3), ("up", "f8", 3), ("fwd", "f8", 3), ("numblades", "i4"), ("radius", "f8"), ("chord", "f8"), \
+            ("twist", "f8"), ("taper", "f8"), ("rel_len_blade_start", "f8"), ("phi0", "f8"), ("ccw", "?")]
+    points = ("center",)
+    directions = ("up", "fwd")
+
+    # The blades are drawn as slabs this thick, relative to their chord
+    thickness = 0.03
+
+    def clearance_shapes(self, records, names):
+        import clearance
+        return [clearance.Disc(name, center, up, radius) for (name, center, up, radius) \
+                in zip(names, records["center"], records["up"], records["radius"])]
+
+    def build(self, records, converter):
+        """The rotor disc, tilted to the rotor's normal, with the blades on it and
+        arrows of 1 m along the normal and forward vectors.  The discs have
+        converter.rotor_segments sides, or as many as the level of detail gives
+        them, and twisted blades one section per 16 sides of their disc; the
+        blades of all rotors with the same number of sections are computed at
+        once."""
+        n = len(records)
+        if not n:
+            return []
+        (centers, radius) = (records["center"], records["radius"])
+        if converter.rotor_segments:
+            sides = np.repeat(converter.rotor_segments, n)
         else:
-            obj.setMatrix(TranslationMatrix(root) * Global.matrix)'''
-
-    def add_flap(self, name, start, end):
-        '''    a = np.array([self.mesh.verts[2].co)
-        b = np.array([self.mesh.verts[5].co)
-        c = 0.2 * (np.array([self.mesh.verts[0].co - a)).normalize()
-        m = self.obj.getMatrix()
-
-        mesh = Blender.Mesh.New()
-        i0 = a + start * (b - a)
-        i1 = a + end * (b - a)
-        mesh.verts.extend([i0, i1, i0 + c, i1 + c])
-        mesh.faces.extend([[0, 1, 3, 2]])
+            sides = converter.lod.segments("disc", radius * 1000)
+        # untwisted blades are straight slabs
+        sections = np.where(records["twist"] != 0, np.maximum(1, sides // 16), 1)
+
+        # Rotor frame: z along the normal, x as close to the global x axis as
+        # possible, turned by phi0 about z
+        angles = np.zeros((n, 3))
+        angles[:, 2] = records["phi0"]
+        frames = np.einsum('nij,njk->nik', transforms.euler_matrices(angles), transforms.track_matrices(records["up"], 'z', 'x'))
+        frames[:, 3, :3] = centers * 1000
+
+        blades = [None] * n
+        for count in np.unique(sections):
+            which = np.flatnonzero(sections == count)
+            for (i, polyhedra) in zip(which, self.build_blades(records[which], frames[which], int(count))):
+                blades[i] = polyhedra
+
+        arrows = draw_arrows(np.concatenate([centers, centers]), np.concatenate([centers + transforms.normalize(records["up"]), \
+                centers + transforms.normalize(records["fwd"])]), converter.lod.segments("line", LINE_RADIUS * 1000))
+
+        meshes = []
+        for i in range(n):
+            disc = multmatrix(transforms.scad_matrix(frames[i]))(
+            color([0.6, 0.4, 0.9, 0.5])
+            (cylinder(h=2, r=float(radius[i]) * 1000, center = True, segments = int(sides[i]))))
+            mesh = union()(disc, color([0.4, 0.2, 0.7, 0.8])(*blades[i]), \
+                    color([0.9, 0.4, 0.3, 0.5])(arrows[i], arrows[n + i]))
+            mesh.set_modifier('background')
+            meshes.append(mesh)
+        return meshes
+
+    def build_blades(self, records, frames, sections):
+        """The blades of each of records, a list of polyhedra per rotor, lofted
+        through sections + 1 sections; frames are the rotor frames."""
+        (centers, radius, numblades) = (records["center"], records["radius"], records["numblades"])
+
+        # Blade frame: x along the blade, y along the chord, z up.  The sections
+        # of all blades, B x sections + 1 x 4 x 3
+        owners = np.repeat(np.arange(len(records)), numblades)
+        blade = np.arange(len(owners)) - np.repeat(np.cumsum(numblades) - numblades, numblades)
+        azimuths = np.zeros((len(owners), 3))
+        azimuths[:, 2] = blade * 360.0 / numblades[owners]
+        span = np.linspace(0, 1, sections + 1)
+        start = (records["rel_len_blade_start"] * radius)[owners, np.newaxis]
+        stations = start + span * (radius[owners, np.newaxis] - start)
+        chords = records["chord"][owners, np.newaxis] * (1 + span * (records["taper"][owners, np.newaxis] - 1))
+        twists = np.where(records["ccw"], 1, -1)[owners, np.newaxis] * records["twist"][owners, np.newaxis] * span * DEG2RAD
+        (half_chord, half_thickness) = (0.5 * chords, 0.5 * self.thickness * chords)
+        (cos, sin) = (np.cos(twists), np.sin(twists))
+        corners = np.empty(stations.shape + (4, 3))
+        corners[..., 0] = stations[..., np.newaxis]
+        for (i, (y, z)) in enumerate([(-1, -1), (1, -1), (1, 1), (-1, 1)]):
+            corners[..., i, 1] = y * half_chord * cos - z * half_thickness * sin
+            corners[..., i, 2] = y * half_chord * sin + z * half_thickness * cos
+        rotations = np.einsum('bij,bjk->bik', transforms.euler_matrices(azimuths)[:, :3, :3], frames[owners, :3, :3])
+        points = np.einsum('bsci,bij->bscj', corners, rotations) + centers[owners, np.newaxis, np.newaxis]
+        points = (points * 1000 + 0.0).reshape(len(owners), -1, 3)
+        faces = loft_faces(sections + 1, 4)
+        blades = [polyhedron(points = p, faces = faces) for p in points.tolist()]
+        return [[blades[b] for b in np.flatnonzero(owners == i)] for i in range(len(records))]
 
-        self.make_twosided(mesh)
 
-        obj = self.scene.objects.new(mesh, name)
-        obj.setMatrix(m)
-        self.set_color(obj, [0.8, 0.8, 0, 0.9])
+class Wing(Item):
+    """Wings and stabs.  Each of the <flap0>, <flap1>, <slat> and <spoiler> child
+    elements sets its (start, end) field; the field is NaN if the element is absent.
+    Surfaces other than vstabs are symmetric, YASim mirrors them at the x-z plane."""
+    flaps = ("flap0", "flap1", "slat", "spoiler")
+    fields = [("root", "f8", 3), ("length", "f8"), ("chord", "f8"), ("incidence", "f8"), ("twist", "f8"), \
+            ("taper", "f8"), ("sweep", "f8"), ("dihedral", "f8"), ("symmetric", "?")] + [(flap, "f8", 2) for flap in flaps]
+    points = ("root",)
+
+    # The surfaces are drawn as flat slabs this thick, relative to the chord,
+    # and the control surfaces as strips along the trailing edge, a quarter of
+    # the root chord but at most 20 cm deep
+    thickness = 0.03
+    flap_depth = 0.25
+    max_flap_depth = 0.2
+
+    def build(self, records, converter):
+        """Polyhedra of all surfaces and their control surfaces, computed at once.
+        The symmetric ones are only drawn on the left side, unless converter.mirror
+        is set."""
+        n = len(records)
+        if not n:
+            return []
+        (chord, length, taper) = (records["chord"], records["length"], records["taper"])
+        sweep = records["sweep"] * DEG2RAD
+        twist = records["twist"] * DEG2RAD
+
+        # Surface frame: x forward along the root chord, y along the span, z up
+        #  3----2     tip
+        #  |    |
+        #  0----1     root, 0 at the trailing edge
+        half = np.zeros((n, 3))
+        half[:, 0] = 0.5 * chord
+        tip = np.zeros((n, 3))
+        tip[:, 0] = -np.sin(sweep) * length
+        tip[:, 1] = np.cos(sweep) * length
+        tiphalf = np.zeros((n, 3))
+        tiphalf[:, 0] = 0.5 * taper * chord * np.cos(twist)
+        tiphalf[:, 2] = 0.5 * taper * chord * np.sin(twist)
+        outline = np.array([-half, half, tip + tiphalf, tip - tiphalf]).transpose(1, 0, 2)
+        thickness = self.thickness * chord[:, np.newaxis] * np.column_stack([np.ones(n), np.ones(n), taper, taper])
+        slabs = [(outline, thickness)]
+
+        # Control surfaces: start and end are fractions of the trailing edge
+        depth = np.minimum(self.flap_depth * chord, self.max_flap_depth)[:, np.newaxis]
+        trailing = outline[:, 3] - outline[:, 0]
+        forward = depth * [1, 0, 0]
+        flaps = []
+        for flap in self.flaps:
+            (start, end) = records[flap].T
+            which = np.flatnonzero(~np.isnan(start))
+            if not len(which):
+                continue
+            i0 = outline[which, 0] + start[which, np.newaxis] * trailing[which]
+            i1 = outline[which, 0] + end[which, np.newaxis] * trailing[which]
+            f = forward[which]
+            flap_outline = np.array([i0, i0 + f, i1 + f, i1]).transpose(1, 0, 2)
+            # a little thicker than the surface, so that they stay visible
+            flap_thickness = 1.5 * thickness[which, :1] * np.ones(4)
+            flaps.append(which)
+            slabs.append((flap_outline, flap_thickness))
+
+        # Turn the slabs by the dihedral and incidence of their surface, and move
+        # them to its root, all in one go
+        owners = np.concatenate([np.arange(n)] + flaps)
+        outlines = np.concatenate([o for (o, t) in slabs])
+        thicknesses = np.concatenate([t for (o, t) in slabs])
+        corners = np.concatenate([outlines, outlines], axis = 1)
+        corners[:, :4, 2] -= 0.5 * thicknesses
+        corners[:, 4:, 2] += 0.5 * thicknesses
+        angles = np.zeros((n, 3))
+        angles[:, 0] = records["dihedral"]
+        angles[:, 1] = -records["incidence"]
+        rotations = transforms.euler_matrices(angles)[:, :3, :3]
+        corners = np.einsum('nvi,nij->nvj', corners, rotations[owners])
+        if converter.matrix is not None:
+            corners = corners.dot(np.asarray(converter.matrix)[:3, :3])
+        corners += records["root"][owners, np.newaxis]
+        corners *= 1000
+
+        polyhedra = slab_polyhedra(corners)
+        mirrored = [None] * len(corners)
+        if converter.mirror:
+            symmetric = np.flatnonzero(records["symmetric"][owners])
+            if len(symmetric):
+                mirror = converter.mirror_matrix()
+                reflected = transforms.transform(corners[symmetric].reshape(-1, 3), mirror).reshape(-1, 8, 3)
+                for (i, polyhedron) in zip(symmetric, slab_polyhedra(reflected, flipped = True)):
+                    mirrored[i] = polyhedron
+
+        meshes = []
+        for i in range(n):
+            surface = color([[0.5, 0.0, 0, 0.5], [0.0, 0.5, 0, 0.5]][bool(records["symmetric"][i])])
+            meshes.append(union()(surface(polyhedra[i])))
+            if mirrored[i] is not None:
+                surface.add(mirrored[i])
+        for i in range(n, len(owners)):
+            flap = color([0.8, 0.8, 0, 0.9])(polyhedra[i])
+            if mirrored[i] is not None:
+                flap.add(mirrored[i])
+            meshes[owners[i]].add(flap)
+        for mesh in meshes:
+            mesh.set_modifier('background')
+        return meshes
+
+
+# Element handlers: import_yasim looks up each element's tag in element_handlers
+# and calls the handler registered for it, if any.  Handlers store their element
+# in the converter's ElementStore, under the element's tag.
+
+REQUIRED = object()
+XYZ = [("x", REQUIRED), ("y", REQUIRED), ("z", REQUIRED)]
+
+element_handlers = {}
+element_items = {}
+
+def element_handler(tags, schema = [], item = None):
+    """Decorator that registers handler(reader, tag, values, parent) for the elements
+    named in tags (separated by spaces), replacing any handler registered before.
+
+    schema lists the element's attributes as (name, default) or (name, default, convert)
+    tuples.  values holds them in that order, converted with convert (float unless given).
+    An attribute whose default is REQUIRED must be present, a default of None is passed
+    on as None.  reader is the import_yasim instance, parent what the handler of the
+    enclosing element returned.
+
+    Elements with an item, an instance of an Item subclass, are stored: the handler
+    returns reader.store.add(tag, row), with row holding the values of item.fields."""
+    schema = [(entry + (float,))[:3] for entry in schema]
+    def register(func):
+        for tag in tags.split():
+            element_handlers[tag] = (func, schema)
+            if item is not None:
+                element_items[tag] = item
+        return func
+    return register
+
+def read_attributes(reader, attrs, schema):
+    values = []
+    for (name, default, convert) in schema:
+        value = attrs.get(name, default)
+        if value is REQUIRED:
+            raise Abort("%s lacks the %s attribute at line %d" % (reader.path(), name, reader.locator.getLineNumber()))
+        if value is not None:
+            value = convert(value)
+        values.append(value)
+    return values
+
+def parent_table(reader, parent, item_class, what):
+    """Returns the table and index of parent, which must be an element of item_class."""
+    if parent is None or not isinstance(parent[0].item, item_class):
+        raise Abort("%s is not part of a %s at line %d" % (reader.path(), what, reader.locator.getLineNumber()))
+    return parent
+
+
+@element_handler("cockpit", XYZ, Cockpit())
+def cockpit_element(reader, tag, (x, y, z), parent):
+    reader.log("\033[31mcockpit x=%f y=%f z=%f\033[m" % (x, y, z))
+    return reader.store.add(tag, [(x, y, z)])
+
+@element_handler("fuselage", [("ax", REQUIRED), ("ay", REQUIRED), ("az", REQUIRED), ("bx", REQUIRED), ("by", REQUIRED), \
+        ("bz", REQUIRED), ("width", REQUIRED), ("taper", 1), ("midpoint", 0.5)], Fuselage())
+def fuselage_element(reader, tag, (ax, ay, az, bx, by, bz, width, taper, midpoint), parent):
+    reader.log("\033[32mfuselage ax=%f ay=%f az=%f bx=%f by=%f bz=%f width=%f taper=%f midpoint=%f\033[m" % \
+            (ax, ay, az, bx, by, bz, width, taper, midpoint))
+    return reader.store.add(tag, [(ax, ay, az), (bx, by, bz), width, taper, midpoint])
+
+@element_handler("gear", XYZ + [("compression", 1), ("upx", None), ("upy", 0), ("upz", 0)], Gear())
+def gear_element(reader, tag, (x, y, z, compression, upx, upy, upz), parent):
+    up = (0, 0, compression)
+    if upx is not None:
+        length = math.sqrt(upx * upx + upy * upy + upz * upz)
+        up = (upx / length * compression, upy / length * compression, upz / length * compression)
+    reader.log("\033[35;1mgear x=%f y=%f z=%f compression=%f upx=%f upy=%f upz=%f\033[m" \
+            % (x, y, z, compression, up[0], up[1], up[2]))
+    return reader.store.add(tag, [(x, y, z), up])
+
+@element_handler("jet", XYZ + [("rotate", 0)], Jet())
+def jet_element(reader, tag, (x, y, z, rotate), parent):
+    reader.log("\033[36;1mjet x=%f y=%f z=%f rotate=%f\033[m" % (x, y, z, rotate))
+    # -X, rotated about the y axis
+    a = rotate * DEG2RAD
+    return reader.store.add(tag, [(x, y, z), (x, y, z), (-math.cos(a), 0, math.sin(a)), rotate])
+
+@element_handler("propeller", XYZ + [("radius", REQUIRED)], Propeller())
+def propeller_element(reader, tag, (x, y, z, radius), parent):
+    reader.log("\033[36;1m%s x=%f y=%f z=%f radius=%f\033[m" % (tag, x, y, z, radius))
+    return reader.store.add(tag, [(x, y, z), (x, y, z), (-1, 0, 0), radius])
+
+@element_handler("thruster", XYZ + [("vx", REQUIRED), ("vy", REQUIRED), ("vz", REQUIRED)], Thruster())
+def thruster_element(reader, tag, (x, y, z, vx, vy, vz), parent):
+    reader.log("\033[36;1m%s x=%f y=%f z=%f vx=%f vy=%f vz=%f\033[m" % (tag, x, y, z, vx, vy, vz))
+    return reader.store.add(tag, [(x, y, z), (x, y, z), (vx, vy, vz)])
+
+@element_handler("actionpt", XYZ)
+def actionpt_element(reader, tag, (x, y, z), parent):
+    (table, index) = parent_table(reader, parent, Thrust, "thruster/propeller/jet")
+    reader.log("\t\033[36mactionpt x=%f y=%f z=%f\033[m" % (x, y, z))
+    table.set(index, "actionpt", (x, y, z))
+
+@element_handler("dir", XYZ)
+def dir_element(reader, tag, (x, y, z), parent):
+    (table, index) = parent_table(reader, parent, Thrust, "thruster/propeller/jet")
+    reader.log("\t\033[36mdir x=%f y=%f z=%f\033[m" % (x, y, z))
+    table.set(index, "thrustvector", (x, y, z))
+
+@element_handler("tank", XYZ + [("capacity", 0), ("capacity-kg", None)], Tank())
+def tank_element(reader, tag, (x, y, z, capacity, capacity_kg), parent):
+    reader.log("\033[34;1m%s x=%f y=%f z=%f capacity=%f\033[m" % (tag, x, y, z, capacity))
+    if capacity_kg is None:
+        capacity_kg = capacity * LBS2KG
+    return reader.store.add(tag, [(x, y, z), capacity_kg])
+
+@element_handler("ballast", XYZ + [("mass-kg", 1)], Ballast())
+def ballast_element(reader, tag, (x, y, z, mass), parent):
+    reader.log("\033[34m%s x=%f y=%f z=%f mass=%f\033[m" % (tag, x, y, z, mass))
+    return reader.store.add(tag, [(x, y, z), mass])
+
+@element_handler("weight", XYZ + [("mass-prop", "", str)], Weight())
+def weight_element(reader, tag, (x, y, z, mass_prop), parent):
+    reader.log("\033[34m%s x=%f y=%f z=%f mass-prop=%s\033[m" % (tag, x, y, z, mass_prop))
+    return reader.store.add(tag, [(x, y, z), mass_prop])
+
+@element_handler("hook", XYZ + [("length", 1), ("up-angle", 0), ("down-angle", 70)], Hook())
+def hook_element(reader, tag, (x, y, z, length, up_angle, down_angle), parent):
+    reader.log("\033[35m%s x=%f y=%f z=%f length=%f up-angle=%f down-angle=%f\033[m" \
+            % (tag, x, y, z, length, up_angle, down_angle))
+    return reader.store.add(tag, [(x, y, z), length, up_angle, down_angle])
+
+@element_handler("hitch", XYZ, Hitch())
+def hitch_element(reader, tag, (x, y, z), parent):
+    reader.log("\033[35m%s x=%f y=%f z=%f\033[m" % (tag, x, y, z))
+    return reader.store.add(tag, [(x, y, z)])
+
+@element_handler("launchbar", XYZ + [("length", 1), ("up-angle", -45), ("down-angle", 45), \
+        ("holdback-x", None), ("holdback-y", None), ("holdback-z", None), ("holdback-length", 2)], Launchbar())
+def launchbar_element(reader, tag, (x, y, z, length, up_angle, down_angle, hx, hy, hz, holdback_length), parent):
+    # the holdback defaults to the launchbar's position
+    holdback = ([hx, x][hx is None], [hy, y][hy is None], [hz, z][hz is None])
+    reader.log("\033[35m%s x=%f y=%f z=%f length=%f down-angle=%f up-angle=%f holdback-x=%f holdback-y=%f holdback-z+%f holdback-length=%f\033[m" \
+            % (tag, x, y, z, length, down_angle, up_angle, \
+            holdback[0], holdback[1], holdback[2], holdback_length))
+    return reader.store.add(tag, [(x, y, z), length, holdback, holdback_length, up_angle, down_angle])
+
+@element_handler("wing hstab vstab mstab", XYZ + [("length", REQUIRED), ("chord", REQUIRED), ("incidence", 0), \
+        ("twist", 0), ("taper", 1), ("sweep", 0), ("dihedral", None)], Wing())
+def wing_element(reader, tag, (x, y, z, length, chord, incidence, twist, taper, sweep, dihedral), parent):
+    if dihedral is None:
+        dihedral = [0.0, 90.0][tag == "vstab"]
+    reader.log("\033[33;1m%s x=%f y=%f z=%f length=%f chord=%f incidence=%f twist=%f taper=%f sweep=%f dihedral=%f\033[m" \
+            % (tag, x, y, z, length, chord, incidence, twist, taper, sweep, dihedral))
+    nan = float("nan")
+    return reader.store.add(tag, [(x, y, z), length, chord, incidence, twist, taper, sweep, dihedral, tag != "vstab"] \
+            + [(nan, nan)] * len(Wing.flaps))
+
+@element_handler("flap0 flap1 slat spoiler", [("start", REQUIRED), ("end", REQUIRED)])
+def flap_element(reader, tag, (start, end), parent):
+    (table, index) = parent_table(reader, parent, Wing, "wing or stab")
+    reader.log("\t\033[33m%s start=%f end=%f\033[m" % (tag, start, end))
+    table.set(index, tag, (start, end))
+
+@element_handler("rotor", [("x", 0), ("y", 0), ("z", 0), ("nx", 0), ("ny", 0), ("nz", 1), ("fx", 1), ("fy", 0), ("fz", 0), \
+        ("diameter", 10.2), ("numblades", 4, int), ("chord", 0.3), ("twist", 0), ("taper", 1), \
+        ("rel-len-blade-start", 0), ("phi0", 0), ("ccw", 0, lambda v: not not int(v))], Rotor())
+def rotor_element(reader, tag, (x, y, z, nx, ny, nz, fx, fy, fz, diameter, numblades, chord, twist, taper, \
+        rel_len_blade_start, phi0, ccw), parent):
+    reader.log(("\033[36;1mrotor x=%f y=%f z=%f nx=%f ny=%f nz=%f fx=%f fy=%f fz=%f numblades=%d diameter=%f " \
+            + "chord=%f twist=%f taper=%f rel_len_blade_start=%f phi0=%f ccw=%d\033[m") \
+            % (x, y, z, nx, ny, nz, fx, fy, fz, numblades, \
+            diameter, chord, twist, taper, rel_len_blade_start, phi0, ccw))
+    return reader.store.add(tag, [(x, y, z), (nx, ny, nz), (fx, fy, fz), numblades, 0.5 * diameter, chord, \
+            twist, taper, rel_len_blade_start, phi0, ccw])
 
-        if self.is_symmetric and Global.mirror_button.val:
-            mod = obj.modifiers.append(Blender.Modifier.Type.MIRROR)
-            mod[Blender.Modifier.Settings.AXIS_X] = False
-            mod[Blender.Modifier.Settings.AXIS_Y] = True
-            mod[Blender.Modifier.Settings.AXIS_Z] = False
-'''
 
 
 class import_yasim(handler.ErrorHandler, handler.ContentHandler):
-    ignored = ["cruise", "approach", "control-input", "control-output", "control-speed", \
+    ignored = frozenset(["cruise", "approach", "control-input", "control-output", "control-speed", \
             "control-setting", "stall", "airplane", "piston-engine", "turbine-engine", \
-            "rotorgear", "tow", "winch", "solve-weight"]
+            "rotorgear", "tow", "winch", "solve-weight"])
 
+    def __init__(self, converter):
+        handler.ContentHandler.__init__(self)
+        self.converter = converter
+        self.store = converter.elements
+        self.log = converter.log
 
     # err_handler
     def warning(self, exception):
@@ -492,8 +1191,10 @@ class import_yasim(handler.ErrorHandler, handler.ContentHandler):
         raise Abort(str(exception), self.error_string("Fatal", exception))
 
     def error_string(self, tag, e):
-        (column, line) = (e.getColumnNumber(), e.getLineNumber())
-        return "%s: %s\n%s%s^"  % (tag, str(e), Global.data[line - 1], column * ' ')
+        return self.error_text(tag, str(e), e.getLineNumber(), e.getColumnNumber())
+
+    def error_text(self, tag, msg, line, column):
+        return "%s: %s\n%s%s^"  % (tag, msg, self.converter.data[line - 1], column * ' ')
 
     # doc_handler
     def setDocumentLocator(self, locator):
@@ -501,175 +1202,24 @@ class import_yasim(handler.ErrorHandler, handler.ContentHandler):
 
     def startDocument(self):
         self.tags = []
-        self.counter = {}
         self.items = [None]
 
-    def endDocument(self):
-        print(scad_render(Item.scene))
-        scad_render_to_file(Item.scene, Global.pathout)
+    def path(self):
+        """The path of the current element, e.g. 'airplane/wing/flap0'."""
+        return "/".join(self.tags)
 
     def startElement(self, tag, attrs):
-        if len(self.tags) == 0 and tag != "airplane":
+        if not self.tags and tag != "airplane":
             raise Abort("this isn't a YASim config file (bad root tag at line %d)" % self.locator.getLineNumber())
 
         self.tags.append(tag)
-        path = string.join(self.tags, '/')
-        item = Item()
-        parent = self.items[-1]
-
-        if self.counter.has_key(tag):
-            self.counter[tag] += 1
-        else:
-            self.counter[tag] = 0
-
-        if tag == "cockpit":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            log("\033[31mcockpit x=%f y=%f z=%f\033[m" % (c[0], c[1], c[2]))
-            item = Cockpit(c)
-
-        elif tag == "fuselage":
-            a = np.array([float(attrs["ax"]), float(attrs["ay"]), float(attrs["az"])])
-            b = np.array([float(attrs["bx"]), float(attrs["by"]), float(attrs["bz"])])
-            width = float(attrs["width"])
-            taper = float(attrs.get("taper", 1))
-            midpoint = float(attrs.get("midpoint", 0.5))
-            log("\033[32mfuselage ax=%f ay=%f az=%f bx=%f by=%f bz=%f width=%f taper=%f midpoint=%f\033[m" % \
-                    (a[0], a[1], a[2], b[0], b[1], b[2], width, taper, midpoint))
-            item = Fuselage("YASim_%s#%d" % (tag, self.counter[tag]), a, b, width, taper, midpoint)
-
-        elif tag == "gear":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            compression = float(attrs.get("compression", 1))
-            up = Z * compression
-            if attrs.has_key("upx"):
-                up = np.linalg.norm(np.array([float(attrs["upx"]), float(attrs["upy"]), float(attrs["upz"])])) * compression
-            log("\033[35;1mgear x=%f y=%f z=%f compression=%f upx=%f upy=%f upz=%f\033[m" \
-                    % (c[0], c[1], c[2], compression, up[0], up[1], up[2]))
-            item = Gear("YASim_gear#%d" % self.counter[tag], c, up)
-
-        elif tag == "jet":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            rotate = float(attrs.get("rotate", 0))
-            log("\033[36;1mjet x=%f y=%f z=%f rotate=%f\033[m" % (c[0], c[1], c[2], rotate))
-            item = Jet("YASim_jet#%d" % self.counter[tag], c, rotate)
-
-        elif tag == "propeller":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            radius = float(attrs["radius"])
-            log("\033[36;1m%s x=%f y=%f z=%f radius=%f\033[m" % (tag, c[0], c[1], c[2], radius))
-            item = Propeller("YASim_propeller#%d" % self.counter[tag], c, radius)
-
-        elif tag == "thruster":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            v = np.array([float(attrs["vx"]), float(attrs["vy"]), float(attrs["vz"])])
-            log("\033[36;1m%s x=%f y=%f z=%f vx=%f vy=%f vz=%f\033[m" % (tag, c[0], c[1], c[2], v[0], v[1], v[2]))
-            item = Thruster("YASim_thruster#%d" % self.counter[tag], c, v)
-
-        elif tag == "actionpt":
-            if not isinstance(parent, Thrust):
-                raise Abort("%s is not part of a thruster/propeller/jet at line %d" \
-                        % (path, self.locator.getLineNumber()))
-
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            log("\t\033[36mactionpt x=%f y=%f z=%f\033[m" % (c[0], c[1], c[2]))
-            parent.set_actionpt(c)
-
-        elif tag == "dir":
-            if not isinstance(parent, Thrust):
-                raise Abort("%s is not part of a thruster/propeller/jet at line %d" \
-                        % (path, self.locator.getLineNumber()))
-
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            log("\t\033[36mdir x=%f y=%f z=%f\033[m" % (c[0], c[1], c[2]))
-            parent.set_dir(c)
-
-        elif tag == "tank":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            log("\033[34;1m%s x=%f y=%f z=%f\033[m" % (tag, c[0], c[1], c[2]))
-            item = Tank("YASim_tank#%d" % self.counter[tag], c)
-
-        elif tag == "ballast":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            mass = float(attrs.get("mass-kg", 1))
-            log("\033[34m%s x=%f y=%f z=%f mass=%f\033[m" % (tag, c[0], c[1], c[2], mass))
-            item = Ballast("YASim_ballast#%d" % self.counter[tag], c, mass)
-
-        elif tag == "weight":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            log("\033[34m%s x=%f y=%f z=%f\033[m" % (tag, c[0], c[1], c[2]))
-            item = Weight("YASim_weight#%d" % self.counter[tag], c)
-
-        elif tag == "hook":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            length = float(attrs.get("length", 1))
-            up_angle = float(attrs.get("up-angle", 0))
-            down_angle = float(attrs.get("down-angle", 70))
-            log("\033[35m%s x=%f y=%f z=%f length=%f up-angle=%f down-angle=%f\033[m" \
-                    % (tag, c[0], c[1], c[2], length, up_angle, down_angle))
-            item = Hook("YASim_hook#%d" % self.counter[tag], c, length, up_angle, down_angle)
-
-        elif tag == "hitch":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            log("\033[35m%s x=%f y=%f z=%f\033[m" % (tag, c[0], c[1], c[2]))
-            item = Hitch("YASim_hitch#%d" % self.counter[tag], c)
-
-        elif tag == "launchbar":
-            c = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            length = float(attrs.get("length", 1))
-            up_angle = float(attrs.get("up-angle", -45))
-            down_angle = float(attrs.get("down-angle", 45))
-            holdback = np.array([float(attrs.get("holdback-x", c[0])), float(attrs.get("holdback-y", c[1])), float(attrs.get("holdback-z", c[2]))])
-            holdback_length = float(attrs.get("holdback-length", 2))
-            log("\033[35m%s x=%f y=%f z=%f length=%f down-angle=%f up-angle=%f holdback-x=%f holdback-y=%f holdback-z+%f holdback-length=%f\033[m" \
-                    % (tag, c[0], c[1], c[2], length, down_angle, up_angle, \
-                    holdback[0], holdback[1], holdback[2], holdback_length))
-            item = Launchbar("YASim_launchbar#%d" % self.counter[tag], c, length, holdback, holdback_length, up_angle, down_angle)
-
-        elif tag == "wing" or tag == "hstab" or tag == "vstab" or tag == "mstab":
-            root = np.array([float(attrs["x"]), float(attrs["y"]), float(attrs["z"])])
-            length = float(attrs["length"])
-            chord = float(attrs["chord"])
-            incidence = float(attrs.get("incidence", 0))
-            twist = float(attrs.get("twist", 0))
-            taper = float(attrs.get("taper", 1))
-            sweep = float(attrs.get("sweep", 0))
-            dihedral = float(attrs.get("dihedral", [0, 90][tag == "vstab"]))
-            log("\033[33;1m%s x=%f y=%f z=%f length=%f chord=%f incidence=%f twist=%f taper=%f sweep=%f dihedral=%f\033[m" \
-                    % (tag, root[0], root[1], root[2], length, chord, incidence, twist, taper, sweep, dihedral))
-            item = Wing("YASim_%s#%d" % (tag, self.counter[tag]), root, length, chord, incidence, twist, taper, sweep, dihedral)
-
-        elif tag == "flap0" or tag == "flap1" or tag == "slat" or tag == "spoiler":
-            if not isinstance(parent, Wing):
-                raise Abort("%s is not part of a wing or stab at line %d" \
-                        % (path, self.locator.getLineNumber()))
-
-            start = float(attrs["start"])
-            end = float(attrs["end"])
-            log("\t\033[33m%s start=%f end=%f\033[m" % (tag, start, end))
-            parent.add_flap("YASim_%s#%d" % (tag, self.counter[tag]), start, end)
-
-        elif tag == "rotor":
-            c = np.array([float(attrs.get("x", 0)), float(attrs.get("y", 0)), float(attrs.get("z", 0))])
-            norm = np.array([float(attrs.get("nx", 0)), float(attrs.get("ny", 0)), float(attrs.get("nz", 1))])
-            fwd = np.array([float(attrs.get("fx", 1)), float(attrs.get("fy", 0)), float(attrs.get("fz", 0))])
-            diameter = float(attrs.get("diameter", 10.2))
-            numblades = int(attrs.get("numblades", 4))
-            chord = float(attrs.get("chord", 0.3))
-            twist = float(attrs.get("twist", 0))
-            taper = float(attrs.get("taper", 1))
-            rel_len_blade_start = float(attrs.get("rel-len-blade-start", 0))
-            phi0 = float(attrs.get("phi0", 0))
-            ccw = not not int(attrs.get("ccw", 0))
-
-            log(("\033[36;1mrotor x=%f y=%f z=%f nx=%f ny=%f nz=%f fx=%f fy=%f fz=%f numblades=%d diameter=%f " \
-                    + "chord=%f twist=%f taper=%f rel_len_blade_start=%f phi0=%f ccw=%d\033[m") \
-                    % (c[0], c[1], c[2], norm[0], norm[1], norm[2], fwd[0], fwd[1], fwd[2], numblades, \
-                    diameter, chord, twist, taper, rel_len_blade_start, phi0, ccw))
-            item = Rotor("YASim_rotor#%d" % self.counter[tag], c, norm, fwd, numblades, 0.5 * diameter, chord, \
-                    twist, taper, rel_len_blade_start, phi0, ccw)
-
-        elif tag not in self.ignored:
-            log("\033[30;1m%s\033[m" % path)
+        item = None
+        entry = element_handlers.get(tag)
+        if entry is not None:
+            (func, schema) = entry
+            item = func(self, tag, read_attributes(self, attrs, schema), self.items[-1])
+        elif tag not in self.ignored and self.converter.verbose:
+            self.log("\033[30;1m%s\033[m" % self.path())
 
         self.items.append(item)
 
@@ -677,9 +1227,67 @@ class import_yasim(handler.ErrorHandler, handler.ContentHandler):
         self.tags.pop()
         self.items.pop()
 
+    def parse(self, path):
+        parser = make_parser()
+        parser.setContentHandler(self)
+        parser.setErrorHandler(self)
+        parser.parse(path)
+
+
+
+class expat_yasim(import_yasim):
+    """Reads YASim files like import_yasim, but drives expat directly rather than
+    through a SAX parser, which saves a layer of calls per element.  The subtrees
+    of ignored elements other than the root hold no geometry and are skipped
+    without even looking at their tags: while in one, expat calls two handlers
+    that only count the depth."""
+    skipped = import_yasim.ignored - frozenset(["airplane"])
+
+    def __init__(self, converter):
+        import_yasim.__init__(self, converter)
+        self.parser = expat.ParserCreate()
+        # the handlers ask the locator for the line of their element
+        self.locator = self
+        self.depth = 0
+
+    def getLineNumber(self):
+        return self.parser.CurrentLineNumber
+
+    def getColumnNumber(self):
+        return self.parser.CurrentColumnNumber
+
+    def start_element(self, tag, attrs):
+        if tag in self.skipped and self.tags:
+            self.depth = 1
+            self.parser.StartElementHandler = self.skip_start
+            self.parser.EndElementHandler = self.skip_end
+        else:
+            self.startElement(tag, attrs)
+
+    def skip_start(self, tag, attrs):
+        self.depth += 1
+
+    def skip_end(self, tag):
+        self.depth -= 1
+        if not self.depth:
+            self.parser.StartElementHandler = self.start_element
+            self.parser.EndElementHandler = self.endElement
+
+    def parse(self, path):
+        self.startDocument()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.endElement
+        try:
+            # the converter has read the file already
+            self.parser.Parse("".join(self.converter.data), True)
+        except expat.ExpatError, e:
+            # as the SAX parser reports them
+            msg = "%s:%d:%d: %s" % (path, e.lineno, e.offset, expat.ErrorString(e.code))
+            raise Abort(msg, self.error_text("Fatal", msg, e.lineno, e.offset))
+
 
 ## extract possible offset matrix see above in destription
-def extract_matrix(filedata, tag):
+def extract_matrix(filedata, tag, log=None):
     v = { 'x': 0.0, 'y': 0.0, 'z': 0.0, 'h': 0.0, 'p': 0.0, 'r': 0.0 }
     has_offsets = False
     for line in filedata:
@@ -698,35 +1306,495 @@ def extract_matrix(filedata, tag):
     if not has_offsets:
         return None
 
-    print(("using offsets: x=%f y=%f z=%f h=%f p=%f r=%f" % (v['x'], v['y'], v['z'], v['h'], v['p'], v['r'])))
-    return Euler(v['r'], v['p'], v['h']).toMatrix().resize4x4() * TranslationMatrix(np.array([v['x'], v['y'], v['z']]))
+    if log:
+        log(("using offsets: x=%f y=%f z=%f h=%f p=%f r=%f" % (v['x'], v['y'], v['z'], v['h'], v['p'], v['r'])))
+    return transforms.euler_matrix(v['r'], v['p'], v['h']) * transforms.translation_matrix([v['x'], v['y'], v['z']])
+
+
+
+class YASimConverter:
+    """Converts YASim files to OpenSCAD.  A converter owns all state of a conversion:
+    the source lines, the model matrix, the elements read and the scene built from
+    them.  Use one converter per thread; a converter can do any number of conversions
+    one after another.
+
+    An incremental converter keeps the rendered SCAD code of each element from one
+    conversion to the next, and only builds and renders the elements that are new or
+    have changed; elements that were dropped from the file are forgotten.
+
+    With mirror set, the symmetric surfaces are drawn on both sides rather than
+    only on the left.  detail and facet_budget set the level of detail of round
+    shapes, see LevelOfDetail.  fuselage_segments and rotor_segments, if given,
+    fix the number of sides of all fuselage tubes and rotor discs instead.  With
+    mass_report set, each conversion prints the mass properties of the point masses
+    under loading (see mass_properties) and marks the center of gravity.  With
+    instancing set, parts that occur more than once, like the markers of equal
+    ballast elements, are written as OpenSCAD modules (see pyopenscad.scad_render).
+    With clearance set to a margin in meters, each conversion prints the parts that
+    come closer to each other than that (see check_clearance), and with highlight
+    set too, the parts that collide are drawn with OpenSCAD's # modifier; with
+    clearance_joined set, parts that are usually joined by design are checked
+    too.  front_end is the XML reader: "expat" (see expat_yasim) or "sax" (see
+    import_yasim); without expat, files are read with SAX."""
+
+    def __init__(self, verbose = True, incremental = False, mirror = False, detail = 1.0, facet_budget = None, \
+            fuselage_segments = None, rotor_segments = None, instancing = True, mass_report = False, loading = {}, \
+            clearance = None, highlight = False, clearance_joined = False, front_end = "expat"):
+        self.verbose = verbose
+        self.incremental = incremental
+        self.mirror = mirror
+        self.lod = LevelOfDetail(detail, facet_budget)
+        self.fuselage_segments = fuselage_segments
+        self.rotor_segments = rotor_segments
+        self.instancing = instancing
+        self.mass_report = mass_report
+        self.loading = loading
+        self.clearance = clearance
+        self.highlight = highlight
+        self.clearance_joined = clearance_joined
+        self.front_end = front_end
+        self.path = None
+        self.data = None
+        self.matrix = None
+        self.elements = None
+        self.scene = None
+        self.nodes = {}
+        self.fragment_caches = {}
+        self.next_fragment_caches = {}
+
+    def mirror_matrix(self):
+        """The matrix that mirrors the scene at the YASim x-z plane."""
+        mirror = np.matrix(np.diag([1.0, -1.0, 1.0, 1.0]))
+        if self.matrix is None:
+            return mirror
+        return self.matrix.I * mirror * self.matrix
+
+    def build(self, table):
+        """Returns the geometry of each element of table, reusing that of the previous
+        conversion where possible.  The geometry of an element only depends on its
+        own record, so it is the same as in a fresh conversion:
+
+        >>> import tempfile
+        >>> path = tempfile.mktemp(".xml")
+        >>> def write(diameters):
+        ...     rotors = ['<rotor x="%d" diameter="%s" twist="-8" numblades="2"/>' % (20 * i, d) for (i, d) in enumerate(diameters)]
+        ...     f = open(path, "w")
+        ...     f.write("<airplane>%s</airplane>" % "".join(rotors))
+        ...     f.close()
+        >>> converter = YASimConverter(verbose = False, incremental = True)
+        >>> write([10, 0.2])
+        >>> scene = converter.convert(path)
+        >>> write([10, 0.3])
+        >>> scad_render(converter.convert(path)) == scad_render(YASimConverter(verbose = False).convert(path))
+        True
+        >>> os.remove(path)
+        """
+        records = table.array
+        if not self.incremental:
+            return table.item.build(records, self)
+
+        # Elements of the same kind whose records are byte for byte the same
+        # have the same geometry
+        data = records.tobytes()
+        size = records.dtype.itemsize
+        keys = [(table.kind, data[i * size:(i + 1) * size]) for i in range(len(records))]
+        missing = [i for (i, key) in enumerate(keys) if key not in self.fragments and key not in self.next_fragments]
+        if missing:
+            for (i, mesh) in zip(missing, table.item.build(records[missing], self)):
+                self.next_fragments[keys[i]] = mesh and prerendered_openscad_object(mesh)
+
+        meshes = []
+        for key in keys:
+            fragment = self.next_fragments.get(key, self.fragments.get(key))
+            self.next_fragments[key] = fragment
+            # a fragment can only belong to one scene
+            meshes.append(fragment and fragment._copy_node())
+        return meshes
+
+    def build_scene(self):
+        """Builds all elements read, and returns the scene with them in file order."""
+        # Most items' geometry depends on the matrix and the level of detail, so
+        # fragments are only reused at the same ones.  There is a cache for each
+        # level of detail the previous conversion was built at.
+        key = (self.matrix is not None and tuple(map(tuple, self.matrix.tolist())), self.lod.scale)
+        self.fragments = self.fragment_caches.get(key, {})
+        self.next_fragments = self.next_fragment_caches.setdefault(key, {})
+        parts = []
+        for table in self.elements.tables.values():
+            parts.extend(zip(table.seq, self.build(table), [table.kind] * len(table), range(len(table))))
+        (self.fragments, self.next_fragments) = (None, None)
+        parts.sort()
+
+        # nodes maps (kind, index) to the position of the element in the scene
+        scene = union()
+        self.nodes = {}
+        for (seq, mesh, kind, index) in parts:
+            if mesh is not None:
+                self.nodes[(kind, index)] = len(scene.children)
+                scene.add(mesh)
+        return scene
+
+    def check_clearance(self, margin = 0.1, joined = False):
+        """The pairs of parts of the file read last (propeller and rotor discs,
+        fuselage tubes, gear contact points and hitches) that are closer to each
+        other than margin meters, see clearance.check_clearance; parts that are
+        usually joined by design are only included with joined set.  Each shape's
+        element is its (kind, index).
+
+        In the example, only the propeller comes close to other parts:
+
+        >>> converter = YASimConverter(verbose = False)
+        >>> converter.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "example-yasim.xml"))
+        >>> for (distance, a, b) in converter.check_clearance(0.1):
+        ...     print("%.4f %s %s" % (distance, a.name, b.name))
+        0.0200 YASim_hitch#0 YASim_propeller#0
+        0.0200 YASim_hitch#1 YASim_propeller#0
+        0.0200 YASim_fuselage#0 YASim_propeller#0
+        0.0200 YASim_fuselage#1 YASim_propeller#0
+        0.0906 YASim_gear#0 YASim_propeller#0
+        0.0970 YASim_rotor#0 YASim_propeller#0
+        >>> min(distance for (distance, a, b) in converter.check_clearance(0.1, joined = True)) < 0
+        True
+        """
+        import clearance
+        shapes = []
+        for table in self.elements.tables.values():
+            names = [table.name(i) for i in range(len(table))]
+            for (i, shape) in enumerate(table.item.clearance_shapes(table.array, names) or []):
+                shape.element = (table.kind, i)
+                shapes.append(shape)
+        return clearance.check_clearance(shapes, margin, joined = joined)
+
+    def highlight_element(self, kind, index):
+        """Draws the element's part of the scene with OpenSCAD's # modifier."""
+        position = self.nodes.get((kind, index))
+        if position is None:
+            return
+        node = self.scene.children[position]
+        # rendered fragments are shared, and can't be changed
+        node = getattr(node, "source", node).copy()
+        node.set_modifier('#')
+        node.set_parent(self.scene)
+        self.scene.children[position] = node
+
+    def mass_properties(self, loadings = [{}]):
+        """The total mass, center of gravity and inertia tensor of the point masses
+        (ballast, tanks and weights) of the file read last, under each of loadings,
+        see mass_properties.  A loading maps FlightGear properties to kg: the
+        mass-prop of weights, which weigh nothing unless set, and the level-kg of
+        tanks, which are full unless set.  Positions are in the scene's frame."""
+        positions = [np.zeros((0, 3))]
+        masses = [np.zeros((len(loadings), 0))]
+        for table in self.elements.tables.values():
+            records = table.array
+            m = table.item.point_masses(records, loadings)
+            if m is not None:
+                positions.append(records["center"])
+                masses.append(m)
+        return mass_properties(np.concatenate(positions), np.concatenate(masses, axis = 1))
+
+    def fit_facet_budget(self):
+        """Rebuilds the scene at lower levels of detail until it has at most
+        lod.facet_budget facets."""
+        budget = self.lod.facet_budget
+        facets = count_facets(self.scene)
+        while facets > budget and not self.lod.lowest:
+            # Facets grow at least linearly with the sides of each shape
+            self.lod.scale *= float(budget) / facets
+            self.scene = self.build_scene()
+            (previous, facets) = (facets, count_facets(self.scene))
+            self.lod.lowest = facets >= previous
+        if facets > budget:
+            self.log("the scene has %d facets, more than the budget of %d, even at the lowest level of detail" \
+                    % (facets, budget))
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def convert(self, pathin, pathout = None):
+        """Reads the YASim file pathin and returns its OpenSCAD scene, also writing it to
+        pathout if given: as a binary STL or 3MF mesh if its extension is .stl or
+        .3mf (see meshexport), otherwise as OpenSCAD code.  Raises Abort on errors
+        in the file."""
+        self.read(pathin)
+        return self.render(pathout)
+
+    def read(self, pathin):
+        """Reads the YASim file pathin, without building anything; see render().
+        Raises Abort on errors in the file.
+
+        Offsets of zero leave the scene as it is:
+
+        >>> import tempfile
+        >>> example = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example-yasim.xml")
+        >>> lines = open(example).readlines()
+        >>> (fd, path) = tempfile.mkstemp(".xml")
+        >>> f = os.fdopen(fd, "w")
+        >>> f.write("".join(lines[:1] + ["<!-- offsets: x=0 -->\\n"] + lines[1:]))
+        >>> f.close()
+        >>> converter = YASimConverter(verbose = False)
+        >>> plain = scad_render(converter.convert(example))
+        >>> scad_render(converter.convert(path)) == plain
+        True
+        >>> os.remove(path)
+        """
+        import_numpy()
+
+        self.log(("loading '%s'" % pathin))
+        f = open(pathin)
+        self.data = f.readlines()
+        f.close()
+
+        self.path = pathin
+        self.elements = ElementStore()
+        # The scene is in YASim coordinates, moved back by the offsets, if any,
+        # as described at the top
+        self.matrix = None
+        matrix = extract_matrix(self.data, "offsets", self.log)
+        if matrix is not None:
+            self.matrix = matrix.I
+
+        if self.front_end == "expat" and expat is not None:
+            expat_yasim(self).parse(pathin)
+        else:
+            import_yasim(self).parse(pathin)
+
+    def render(self, pathout = None, overrides = {}):
+        """Builds and returns the scene of the file read last, and writes it to pathout
+        if given, like convert().  It can be called any number of times, each time
+        with other overrides: a dict that maps ElementStore.override() keys to
+        values, and FlightGear properties (starting with '/') to the kg they add to
+        the loading.  With an incremental converter only the elements that differ
+        from those of the previous call are built again."""
+        self.elements.reset()
+        loading = dict(self.loading)
+        for (key, value) in overrides.items():
+            if key.startswith("/"):
+                loading[key] = value
+            else:
+                self.elements.override(key, value)
+
+        if self.matrix is not None:
+            self.elements.transform(self.matrix)
+        # Each conversion fits the budget anew, from the full level of detail
+        self.lod.reset()
+        self.next_fragment_caches = {}
+        self.scene = self.build_scene()
+        if self.lod.facet_budget:
+            self.fit_facet_budget()
+        (self.fragment_caches, self.next_fragment_caches) = (self.next_fragment_caches, {})
+        if self.mass_report:
+            (total, cg, inertia) = self.mass_properties([loading])
+            print("%s:\n%s" % (pathout or self.path, mass_report(total[0], cg[0], inertia[0])))
+            if total[0]:
+                self.scene.add(draw_cg_marker(cg[0], self.lod.segments("marker", 25)))
+        if self.clearance is not None:
+            import clearance
+            results = self.check_clearance(self.clearance, self.clearance_joined)
+            print("%s:\n%s" % (pathout or self.path, clearance.clearance_report(results)))
+            if self.highlight:
+                for (distance, a, b) in results:
+                    if distance <= 0:
+                        self.highlight_element(*a.element)
+                        self.highlight_element(*b.element)
+
+        if self.verbose:
+            print(scad_render(self.scene, instancing = self.instancing))
+        if pathout:
+            import meshexport
+            if os.path.splitext(pathout)[1].lower() in meshexport.MESH_FORMATS:
+                meshexport.mesh_render_to_file(self.scene, pathout)
+            else:
+                scad_render_to_file(self.scene, pathout, instancing = self.instancing)
+        return self.scene
+
+
+
+def load_yasim_config(pathin, pathout, settings = {}):
+    try:
+        convert_yasim_config(pathin, pathout, **settings)
+    except Abort, e:
+        print(("%s\nAborting ..." % (e.term or e.msg)))
 
+def convert_yasim_config(pathin, pathout, verbose = True, **settings):
+    """Converts one YASim file to an OpenSCAD file; raises Abort on errors in the file.
+    settings are passed on to YASimConverter, e.g. mirror = True."""
+    return YASimConverter(verbose, **settings).convert(pathin, pathout)
 
 
-def load_yasim_config(pathin, pathout):
 
-    xml_handler = import_yasim()
-    Global.yasim = make_parser()
-    Global.yasim.setContentHandler(xml_handler)
-    Global.yasim.setErrorHandler(xml_handler)
+def batch_output_path(pathin, outdir, extension = ".scad"):
+    base = os.path.splitext(pathin)[0] + extension
+    if outdir:
+        return os.path.join(outdir, os.path.basename(base))
+    return base
 
-    print(("loading '%s'" % pathin))
+def read_manifest(path):
+    """Reads a batch manifest: one YASim file per line, optionally followed by
+    its output file; blank lines and lines starting with '#' are skipped."""
+    jobs = []
+    f = open(path)
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split(None, 1)
+        jobs.append((fields[0], fields[1] if len(fields) > 1 else None))
+    f.close()
+    return jobs
+
+def batch_convert_one(job):
+    """Converts a single (pathin, pathout, settings) job of a batch run.  Never
+    raises, so that one broken file doesn't take the others down; returns
+    (pathin, pathout, seconds, error)."""
+    (pathin, pathout, settings) = job
+    start = time.time()
+    error = None
     try:
-        f = open(pathin)
-        Global.data = f.readlines()
-        f.close
-
-        Global.path = pathin
-        Global.pathout = pathout
-        Global.matrix = YASIM_MATRIX
-        matrix = extract_matrix(Global.data, "offsets")
-        if matrix:
-            Global.matrix *= matrix.invert()
+        convert_yasim_config(pathin, pathout, verbose = False, **settings)
+    except Abort, e:
+        error = e.term or e.msg
+    except Exception, e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    return (pathin, pathout, time.time() - start, error)
+
+def batch_convert(jobs, processes=None, settings={}):
+    """Converts a list of (pathin, pathout) jobs on a pool of processes (one per CPU
+    by default) and prints a summary.  settings are passed on to YASimConverter.
+    Returns the list of batch_convert_one() results."""
+    start = time.time()
+    jobs = [(pathin, pathout, settings) for (pathin, pathout) in jobs]
+    if processes == 1 or len(jobs) < 2:
+        results = [batch_convert_one(job) for job in jobs]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(batch_convert_one, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    wall = time.time() - start
+
+    failed = [r for r in results if r[3] is not None]
+    for (pathin, pathout, seconds, error) in results:
+        print("%-8s %7.1f ms  %s -> %s" % (["ok", "FAILED"][error is not None], seconds * 1000, pathin, pathout))
+    for (pathin, pathout, seconds, error) in failed:
+        print("\n%s:\n%s" % (pathin, error))
+    print("\n%d converted, %d failed; %.2f s wall time, %.2f s conversion time" \
+            % (len(results) - len(failed), len(failed), wall, sum(r[2] for r in results)))
+    return results
+
+
+
+def read_variants(path):
+    """Reads a sweep table: a JSON file (.json) holding a list of objects, or a CSV
+    file with a header row.  Each object or row is a variant, whose keys or columns
+    are the overrides of YASimConverter.render(); an optional 'name' names the
+    variant, empty CSV cells are skipped.  Returns a list of (name, overrides)."""
+    f = open(path)
+    try:
+        if path.lower().endswith(".json"):
+            import json
+            rows = json.load(f)
+        else:
+            import csv
+            rows = list(csv.DictReader(f))
+    finally:
+        f.close()
+
+    variants = []
+    for (i, row) in enumerate(rows):
+        name = str(row.get("name") or "%03d" % i)
+        try:
+            overrides = dict((key.strip(), float(value)) for (key, value) in row.items() \
+                    if key != "name" and value not in ("", None))
+        except ValueError, e:
+            raise Abort("%s: variant %s: %s" % (path, name, e))
+        variants.append((name, overrides))
+    return variants
+
+# The converter of a sweep, one per process, which has read the YASim file
+sweep_converter = None
+
+def sweep_init(pathin, settings):
+    global sweep_converter
+    if sweep_converter is not None and sweep_converter.path == pathin:
+        # forked from the process that already read it
+        return
+    sweep_converter = YASimConverter(verbose = False, incremental = True, **settings)
+    sweep_converter.read(pathin)
+
+def sweep_one(job):
+    """Renders a single (name, overrides, pathout) variant of a sweep; like
+    batch_convert_one(), returns (name, pathout, seconds, error).  Each variant
+    is fitted to the facet budget on its own, so its output doesn't depend on
+    the variants the process rendered before:
+
+    >>> example = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example-yasim.xml")
+    >>> sweep_init(example, {"facet_budget": 600})
+    >>> import tempfile
+    >>> pathout = tempfile.mktemp(".scad")
+    >>> def rendered(overrides):
+    ...     sweep_one(("variant", overrides, pathout))
+    ...     return open(pathout).read()
+    >>> plain = rendered({})
+    >>> wide = rendered({"fuselage.width": 3})
+    >>> wide != plain
+    True
+    >>> rendered({}) == plain
+    True
+    >>> os.remove(pathout)
+    """
+    (name, overrides, pathout) = job
+    start = time.time()
+    error = None
+    try:
+        sweep_converter.render(pathout, overrides)
+    except Abort, e:
+        error = e.term or e.msg
+    except Exception, e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    return (name, pathout, time.time() - start, error)
+
+def sweep(pathin, variants, outdir = None, extension = ".scad", processes = None, settings = {}):
+    """Renders each (name, overrides) variant of the YASim file pathin (see
+    read_variants) to a file named after pathin and the variant, in outdir or next
+    to pathin, on a pool of processes (one per CPU by default), and prints a
+    summary.  The file is read once; each process keeps an incremental converter,
+    so that the elements a variant doesn't change are reused at the same level
+    of detail.  Raises Abort on errors in the file; returns the list of
+    sweep_one() results."""
+    start = time.time()
+    sweep_init(pathin, settings)
+    base = batch_output_path(pathin, outdir, "-")
+    jobs = [(name, overrides, base + name + extension) for (name, overrides) in variants]
+    if processes == 1 or len(jobs) < 2:
+        results = [sweep_one(job) for job in jobs]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, sweep_init, (pathin, settings))
+        try:
+            # Variants next to each other tend to share more elements, so each
+            # process gets runs of them
+            chunksize = max(1, len(jobs) // (4 * (processes or multiprocessing.cpu_count())))
+            results = pool.map(sweep_one, jobs, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    wall = time.time() - start
+
+    failed = [r for r in results if r[3] is not None]
+    for (name, pathout, seconds, error) in results:
+        print("%-8s %7.1f ms  %s -> %s" % (["ok", "FAILED"][error is not None], seconds * 1000, name, pathout))
+    for (name, pathout, seconds, error) in failed:
+        print("\n%s:\n%s" % (name, error))
+    print("\n%d variants rendered, %d failed; %.2f s wall time, %.2f s rendering time" \
+            % (len(results) - len(failed), len(failed), wall, sum(r[2] for r in results)))
+    return results
 
-        Global.yasim.parse(pathin)
 
-    except Abort, e:
-        print(("%s\nAborting ..." % (e.term or e.msg)))
 
 def create_scad(filename):
     d = difference()(
@@ -734,19 +1802,168 @@ def create_scad(filename):
         sphere(7).set_modifier('background')
     )
 
-    Global.test= 5
-
-    #print(Global.data)
-
 #    print (scad_render(d))
     scad_render_to_file(d, filename)
 
+def watch(pathin, pathout, interval = 0.2, settings = {}):
+    """Converts pathin to pathout, and again whenever pathin changes, until interrupted.
+    The process and its converter stay warm, only changed elements are rebuilt, and the
+    output file is replaced atomically, so OpenSCAD's automatic reload picks up each
+    change right away."""
+    converter = YASimConverter(verbose = False, incremental = True, **settings)
+    stamp = None
+    generated = False
+    print("watching '%s' for changes, writing '%s' (Ctrl-C to stop)" % (pathin, pathout))
+    try:
+        while True:
+            try:
+                st = os.stat(pathin)
+            except OSError:
+                # e.g. while an editor is replacing the file
+                st = None
+            if st is not None and (st.st_mtime, st.st_size) != stamp:
+                stamp = (st.st_mtime, st.st_size)
+                detected = time.time()
+                try:
+                    converter.convert(pathin, pathout)
+                    done = time.time()
+                    if generated:
+                        print("regenerated in %.1f ms, %.1f ms after the change was saved" \
+                                % ((done - detected) * 1000, max(done - st.st_mtime, 0) * 1000))
+                    else:
+                        print("generated in %.1f ms" % ((done - detected) * 1000))
+                    generated = True
+                except Abort, e:
+                    print("%s\nkeeping the previous output" % (e.term or e.msg))
+                except Exception, e:
+                    print("%s: %s\nkeeping the previous output" % (e.__class__.__name__, e))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+
 def main():
-    if len(sys.argv) != 3:
+    if len(sys.argv) == 3 and not sys.argv[1].startswith("-") and not sys.argv[2].startswith("-"):
+        load_yasim_config(sys.argv[1],sys.argv[2])
+        return
+
+    import argparse
+    parser = argparse.ArgumentParser(usage="%(prog)s [--mirror] [--detail F] [--facet-budget N] YASimfile scadfile\n" \
+            + "       %(prog)s --watch [--interval SECONDS] YASimfile [scadfile]\n" \
+            + "       %(prog)s --batch [-j N] [-o DIR] [-m MANIFEST] [YASimfile|glob ...]\n" \
+            + "       %(prog)s --sweep TABLE [-j N] [-o DIR] YASimfile")
+    parser.add_argument("--watch", action="store_true",
+            help="keep running and regenerate the scadfile whenever the YASimfile changes")
+    parser.add_argument("--interval", type=float, default=0.2, metavar="SECONDS",
+            help="how often --watch checks for changes (default: 0.2)")
+    parser.add_argument("--batch", action="store_true",
+            help="convert many YASim files in parallel; outputs go next to the inputs (or into DIR) with a .scad (or --format) extension")
+    parser.add_argument("--sweep", metavar="TABLE",
+            help="render a variant of the YASimfile for each row of TABLE (.csv or .json), whose columns " \
+            + "override element fields (e.g. ballast#0.mass, rotor#0.phi0, propeller#1.center.x) or --load properties")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("-o", "--output-dir", metavar="DIR", help="write the batch outputs into DIR")
+    parser.add_argument("-m", "--manifest", action="append", default=[],
+            help="file listing one YASim file per line, optionally followed by its output file")
+    parser.add_argument("--mirror", action="store_true",
+            help="draw symmetric surfaces on both sides, not only on the left")
+    parser.add_argument("--detail", type=float, default=1.0, metavar="F",
+            help="level of detail of round shapes; 2 doubles their sides, 0.5 halves them (default: 1)")
+    parser.add_argument("--facet-budget", type=int, metavar="N",
+            help="lower the level of detail until the scene has at most about N facets")
+    parser.add_argument("--fuselage-segments", type=int, metavar="N",
+            help="number of sides of all fuselage tubes, whatever the level of detail")
+    parser.add_argument("--rotor-segments", type=int, metavar="N",
+            help="number of sides of all rotor discs; twisted blades get one section per 16")
+    parser.add_argument("--format", choices=["scad", "stl", "3mf"], default="scad",
+            help="file type of outputs that aren't named, of --batch and --watch (default: scad); " \
+            + "named outputs get the type of their extension")
+    parser.add_argument("--mass", action="store_true",
+            help="print the mass, CG and inertia of the ballast, tanks and weights, and mark the CG")
+    parser.add_argument("--load", action="append", default=[], metavar="PROPERTY=KG",
+            help="set the property a weight's mass-prop names, or a tank's " \
+            + "/consumables/fuel/tank[N]/level-kg, for --mass; tanks are full and weights empty unless set")
+    parser.add_argument("--clearance", type=float, metavar="MARGIN",
+            help="print the propellers, rotors, fuselages, gear and hitches that come closer " \
+            + "to each other than MARGIN meters, e.g. 0.1")
+    parser.add_argument("--highlight", action="store_true",
+            help="with --clearance, draw the parts that collide with OpenSCAD's # modifier")
+    parser.add_argument("--joined", action="store_true",
+            help="with --clearance, also check fuselage tubes against each other and gear and hitches " \
+            + "inside fuselages, which are usually joined by design")
+    parser.add_argument("--parser", choices=["expat", "sax"], default="expat",
+            help="XML reader; sax is slower but works without expat (default: expat)")
+    parser.add_argument("--no-instancing", dest="instancing", action="store_false",
+            help="write repeated parts out in full rather than as OpenSCAD modules")
+    parser.add_argument("inputs", nargs="*", help="YASim files or glob patterns")
+    # inputs may come before and after the options
+    (args, extra) = parser.parse_known_args()
+    for arg in extra:
+        if arg.startswith("-"):
+            parser.error("unrecognized arguments: %s" % arg)
+        args.inputs.append(arg)
+    if [n for n in (args.fuselage_segments, args.rotor_segments) if n is not None and n < 3]:
+        parser.error("--fuselage-segments and --rotor-segments must be at least 3")
+    if args.detail <= 0:
+        parser.error("--detail must be positive")
+    loading = {}
+    for assignment in args.load:
+        (prop, equals, mass) = assignment.partition("=")
+        try:
+            loading[prop.strip()] = float(mass)
+        except ValueError:
+            parser.error("--load takes PROPERTY=KG, not %s" % assignment)
+    settings = {"mirror": args.mirror, "mass_report": args.mass, "loading": loading, \
+            "clearance": args.clearance, "highlight": args.highlight, \
+            "clearance_joined": args.joined, "detail": args.detail, "facet_budget": args.facet_budget, \
+            "fuselage_segments": args.fuselage_segments, "rotor_segments": args.rotor_segments, "instancing": args.instancing, \
+            "front_end": args.parser}
+
+    if args.watch:
+        if len(args.inputs) not in (1, 2):
+            parser.error("--watch takes a YASimfile and optionally a scadfile")
+        watch(args.inputs[0], args.inputs[-1] if len(args.inputs) == 2 else batch_output_path(args.inputs[0], None, "." + args.format), \
+                args.interval, settings)
+        return
+
+    if args.sweep:
+        if len(args.inputs) != 1:
+            parser.error("--sweep takes a single YASimfile")
+        if args.output_dir and not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        try:
+            results = sweep(args.inputs[0], read_variants(args.sweep), args.output_dir, "." + args.format, args.jobs, settings)
+        except Abort, e:
+            print(("%s\nAborting ..." % (e.term or e.msg)))
+            sys.exit(1)
+        if [r for r in results if r[3] is not None]:
+            sys.exit(1)
+        return
+
+    if not args.batch and len(args.inputs) == 2:
+        load_yasim_config(args.inputs[0], args.inputs[1], settings)
+        return
+
+    if not args.batch:
         sys.stderr.write("Invalid number of arguments.\n")
         sys.stderr.write("Usage: %s YASimfile scadfile\n" % (sys.argv[0], ))
         sys.exit(1)
 
-    load_yasim_config(sys.argv[1],sys.argv[2])
+    jobs = []
+    for manifest in args.manifest:
+        jobs.extend(read_manifest(manifest))
+    for pattern in args.inputs:
+        jobs.extend((pathin, None) for pathin in sorted(glob.glob(pattern)) or [pattern])
+    jobs = [(pathin, pathout or batch_output_path(pathin, args.output_dir, "." + args.format)) for (pathin, pathout) in jobs]
+    if not jobs:
+        parser.error("no input files")
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    results = batch_convert(jobs, args.jobs, settings)
+    if [r for r in results if r[3] is not None]:
+        sys.exit(1)
 
-main()
+if __name__ == "__main__":
+    main()